@@ -20,60 +20,132 @@
   3. This notice may not be removed or altered from any source distribution.
 """
 
-import argparse, os, shlex, subprocess, sys
+import argparse, ast, functools, os, shlex, shutil, subprocess, sys, tempfile
 
 sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'helpers'))
+from commandstore import parsesize
 from filterblobs import filterblobs
+from profiling import finishprofiling, initprofiling
+
+# Note: The filters are run in worker processes, so they are given all their
+# settings as arguments (bound with functools.partial) instead of reading any
+# globals that are set from the command line.
 
-_FILTER_COMMAND = ''
 _FILE_EXT_FILTER = ['c', 'cpp', 'cxx', 'cc', 'h', 'hpp', 'hxx', 'hh']
 _BLOB_SIZE_LIMIT = 200000
 _DEFAULT_BRANCH = 'master'
+_BATCH_SIZE = 0
+_SCRATCH_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
 
-def _NAME_FILTER(file_name):
-    if len(_FILE_EXT_FILTER) < 1:
+def _NAME_FILTER(file_ext_filter, file_name):
+    if len(file_ext_filter) < 1:
         return True
     file_name_lower = file_name.lower()
-    for ext in _FILE_EXT_FILTER:
+    for ext in file_ext_filter:
         if len(file_name_lower) > len(ext) and file_name_lower.endswith(ext):
             if file_name_lower[len(file_name_lower) - len(ext) - 1] == '.':
                 return True
     return False
 
-def _BLOB_FILTER(file_name, blob):
-    if len(blob) > _BLOB_SIZE_LIMIT:
+def _BLOB_FILTER(filter_command, blob_size_limit, file_name, blob):
+    if len(blob) > blob_size_limit:
         return blob
-    cmd = shlex.split(_FILTER_COMMAND.replace('%f', file_name))
+    cmd = shlex.split(filter_command.replace('%f', file_name))
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
     res = p.communicate(input=blob)
     return res[0]
 
-# Handle the program arguments.
-parser = argparse.ArgumentParser(
-    formatter_class=argparse.RawTextHelpFormatter,
-    description='Run a filter (command) on all files in the Git history of a repo, creating a new repo.')
-parser.add_argument('-f', '--file-filter', metavar='FILE-FILTER', help='file extension filter (comma separated list of extensions)\nDefault: ' + ','.join(_FILE_EXT_FILTER))
-parser.add_argument('-l', '--size-limit', metavar='LIMIT', help='blob size limit in bytes (do not filter blobs larger than this)\nDefault: ' + str(_BLOB_SIZE_LIMIT))
-parser.add_argument('-b', '--branch', metavar='BRANCH', help='main branch (will be checked out in the new repo)\nDefault: ' + _DEFAULT_BRANCH)
-parser.add_argument('input', metavar='INPUT', help='path to the source Git repo')
-parser.add_argument('output', metavar='OUTPUT', help='path to the rewritten Git repo')
-parser.add_argument('filter', metavar='FILTER', help='blob filter command (a string)\nThe command will get the original data blob from STDIN,\nand the rewritten blob is expected on STDOUT.')
-args = parser.parse_args()
-
-_FILTER_COMMAND = args.filter
-if args.file_filter:
-    _FILE_EXT_FILTER = args.file_filter.lower().split(',')
-if args.size_limit:
-    _BLOB_SIZE_LIMIT = int(args.size_limit)
-if args.branch:
-    branch = args.branch
-else:
-    branch = _DEFAULT_BRANCH
-
-print 'Using file filter: %s' % (','.join(_FILE_EXT_FILTER))
-print 'Blob size limit:   %d' % (_BLOB_SIZE_LIMIT)
-print 'Main branch:       %s' % (branch)
-
-# Execute filter-blobs function.
-filterblobs(args.input, args.output, _NAME_FILTER, _BLOB_FILTER, branch)
+# Get the relative path of a file name from the export (unquote C-style quoted
+# names).
+def _UNQUOTE_FILE_NAME(file_name):
+    if file_name[:1] == '"':
+        return os.fsdecode(ast.literal_eval('b' + file_name))
+    return file_name
+
+def _BATCH_FILTER(filter_command, blob_size_limit, scratch_dir, file_names, blobs):
+    # Write the blobs to a scratch tree, using their real relative paths.
+    scratch_root = tempfile.mkdtemp(prefix='git-filter-blobs-', dir=scratch_dir)
+    try:
+        paths = []
+        for k in range(len(file_names)):
+            if len(blobs[k]) > blob_size_limit:
+                continue
+            path = _UNQUOTE_FILE_NAME(file_names[k])
+            full_path = os.path.join(scratch_root, path)
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            with open(full_path, 'wb') as f:
+                f.write(blobs[k])
+            paths.append(path)
+
+        # Run the filter command in-place on all the files (a failure aborts
+        # the run, or the unfiltered files would be imported).
+        if paths:
+            cmd = shlex.split(filter_command) + paths
+            subprocess.check_call(cmd, cwd=scratch_root)
+
+        # Read back the results.
+        result = []
+        for k in range(len(file_names)):
+            if len(blobs[k]) > blob_size_limit:
+                result.append(blobs[k])
+            else:
+                with open(os.path.join(scratch_root, _UNQUOTE_FILE_NAME(file_names[k])), 'rb') as f:
+                    result.append(f.read())
+        return result
+    finally:
+        shutil.rmtree(scratch_root)
+
+def main():
+    # Handle the program arguments.
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description='Run a filter (command) on all files in the Git history of a repo, creating a new repo.')
+    parser.add_argument('-f', '--file-filter', metavar='FILE-FILTER', help='file extension filter (comma separated list of extensions)\nDefault: ' + ','.join(_FILE_EXT_FILTER))
+    parser.add_argument('-l', '--size-limit', metavar='LIMIT', help='blob size limit in bytes (do not filter blobs larger than this)\nDefault: ' + str(_BLOB_SIZE_LIMIT))
+    parser.add_argument('-m', '--max-memory', metavar='SIZE', type=parsesize, help='memory budget for the command stream, e.g. 4G (spill to\ntemporary files when exceeded, see TMPDIR)')
+    parser.add_argument('-O', '--optimize', action='store_true', help='optimize the new repo (repack, and write bitmaps and a commit-graph)')
+    parser.add_argument('-B', '--batch-size', metavar='N', help='filter the blobs in batches of up to N files (FILTER is then\nan in-place command, e.g. "clang-format -i", that is run on\nthe batch of files, which are written to a scratch tree using\ntheir real paths, and it must exit with status 0)')
+    parser.add_argument('-s', '--scratch-dir', metavar='DIR', help='directory for the scratch trees in batch mode (a config\nfile placed here, e.g. .clang-format, is found by the filter)\nDefault: ' + _SCRATCH_DIR)
+    parser.add_argument('-v', '--verify', action='store_true', help='verify that every rewritten commit matches its source commit\n(only files that pass the file filter may differ)')
+    parser.add_argument('-t', '--timing-file', metavar='FILE', help='file with the filter time per file type from previous runs\n(used for scheduling the most expensive jobs first, and\nupdated after the run)')
+    parser.add_argument('--profile', metavar='DIR', help='write profiles of the parent and the worker processes, and a\nsummary of the hot functions per phase, to DIR')
+    parser.add_argument('-b', '--branch', metavar='BRANCH', help='main branch (will be checked out in the new repo)\nDefault: ' + _DEFAULT_BRANCH)
+    parser.add_argument('input', metavar='INPUT', help='path to the source Git repo')
+    parser.add_argument('output', metavar='OUTPUT', help='path to the rewritten Git repo')
+    parser.add_argument('filter', metavar='FILTER', help='blob filter command (a string)\nThe command will get the original data blob from STDIN,\nand the rewritten blob is expected on STDOUT.')
+    args = parser.parse_args()
+
+    filter_command = args.filter
+    file_ext_filter = args.file_filter.lower().split(',') if args.file_filter else _FILE_EXT_FILTER
+    blob_size_limit = int(args.size_limit) if args.size_limit else _BLOB_SIZE_LIMIT
+    branch = args.branch if args.branch else _DEFAULT_BRANCH
+    max_memory = args.max_memory
+    batch_size = int(args.batch_size) if args.batch_size else _BATCH_SIZE
+    scratch_dir = os.path.abspath(args.scratch_dir) if args.scratch_dir else _SCRATCH_DIR
+    if args.profile:
+        initprofiling(args.profile)
+
+    print('Using file filter: %s' % (','.join(file_ext_filter)))
+    print('Blob size limit:   %d' % (blob_size_limit))
+    print('Main branch:       %s' % (branch))
+    if batch_size > 0:
+        print('Batch size:        %d' % (batch_size))
+        print('Scratch directory: %s' % (scratch_dir))
+
+    # Execute filter-blobs function.
+    name_filter = functools.partial(_NAME_FILTER, file_ext_filter)
+    if batch_size > 0:
+        batch_filter = functools.partial(_BATCH_FILTER, filter_command, blob_size_limit, scratch_dir)
+        ok = filterblobs(args.input, args.output, name_filter, None, branch, max_memory, args.optimize, batch_filter, batch_size,
+                         args.verify, args.timing_file, blob_size_limit)
+    else:
+        blob_filter = functools.partial(_BLOB_FILTER, filter_command, blob_size_limit)
+        ok = filterblobs(args.input, args.output, name_filter, blob_filter, branch, max_memory, args.optimize,
+                         verify=args.verify, timing_file=args.timing_file, blob_size_limit=blob_size_limit)
+    finishprofiling()
+    if not ok:
+        sys.exit(1)
 
+if __name__ == '__main__':
+    main()
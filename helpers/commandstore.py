@@ -0,0 +1,237 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+"""
+  Copyright (C) 2017 Marcus Geelnard
+
+  This software is provided 'as-is', without any express or implied
+  warranty.  In no event will the authors be held liable for any damages
+  arising from the use of this software.
+
+  Permission is granted to anyone to use this software for any purpose,
+  including commercial applications, and to alter it and redistribute it
+  freely, subject to the following restrictions:
+
+  1. The origin of this software must not be misrepresented; you must not
+     claim that you wrote the original software. If you use this software
+     in a product, an acknowledgment in the product documentation would be
+     appreciated but is not required.
+  2. Altered source versions must be plainly marked as such, and must not be
+     misrepresented as being the original software.
+  3. This notice may not be removed or altered from any source distribution.
+"""
+
+import argparse, array, mmap, os, subprocess, tempfile
+
+# Approximate memory overhead for keeping a command in memory (object header
+# and list slot), in bytes.
+_COMMAND_OVERHEAD = 64
+
+# Prefix for temporary files (created in the default temporary directory, which
+# can be changed with the TMPDIR environment variable).
+_TEMP_PREFIX = 'git-tools-'
+
+# Array type code for file offsets (64-bit).
+_OFFSET_TYPE = 'q'
+
+# Where the commands of a spilled command store are kept.
+_IN_FILE = 0
+_VIEW_IN_FILE = 1
+_IN_SOURCE = 2
+
+# Parse a size string, e.g. '512M' or '4G', into a number of bytes (also used as
+# an argparse type, so an invalid size gives a usage error).
+def parsesize(size_str):
+    units = { 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40 }
+    value_str = size_str.strip().lower()
+    if value_str[-1:] == 'b':
+        value_str = value_str[:-1]
+    scale = 1
+    if value_str[-1:] in units:
+        scale = units[value_str[-1:]]
+        value_str = value_str[:-1]
+    try:
+        size = int(float(value_str) * scale)
+    except (ValueError, OverflowError):
+        size = 0
+    if size <= 0:
+        raise argparse.ArgumentTypeError('invalid size: \'' + size_str + '\' (expected e.g. 512M or 4G)')
+    return size
+
+# Run a command and return its output. If a memory budget is given, the output
+# is written to a temporary file that is memory mapped, instead of being read
+# into memory.
+def checkoutput(cmd, max_memory = None):
+    if not max_memory:
+        return subprocess.check_output(cmd)
+    with tempfile.TemporaryFile(prefix=_TEMP_PREFIX) as f:
+        subprocess.check_call(cmd, stdout=f)
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+# Read a file. If a memory budget is given, the file is memory mapped instead of
+# being read into memory.
+def readfile(path, max_memory = None):
+    with open(path, 'rb') as f:
+        if not max_memory:
+            return f.read()
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+# Get the amount of memory that a command in a command store is charged for (a
+# part of a source buffer, stored as a (start, end) tuple, is not owned).
+def _memorysize(cmd):
+    if isinstance(cmd, tuple):
+        return _COMMAND_OVERHEAD
+    return len(cmd) + _COMMAND_OVERHEAD
+
+# Create a new (empty) list of commands.
+def newcommandlist(max_memory = None):
+    return CommandStore(max_memory) if max_memory else []
+
+# Append a part of a source buffer (e.g. a memory mapped export) to a list of
+# commands, as a memoryview. A command store only records the position of the
+# part, so it is neither copied nor charged to the memory budget.
+def appendsource(commands, source_view, start, end):
+    if isinstance(commands, CommandStore):
+        commands.appendsource(source_view, start, end)
+    else:
+        commands.append(source_view[start:end])
+
+# A list of commands (byte strings or memoryviews) with a memory budget.
+# The commands are kept in memory until the total size of all the command
+# stores exceeds the budget. The store that is being appended to is then spilled
+# to a temporary file, and from there on all its commands are read from a
+# memory mapping of that file. Commands that were stored as memoryviews are
+# returned as memoryviews of the mapping (i.e. they are not copied).
+# Commands that refer to a source buffer (see appendsource()) are never spilled,
+# and are returned as memoryviews of the source buffer.
+class CommandStore(object):
+    # Total size of the commands that are kept in memory (for all stores).
+    _memory_used = 0
+
+    def __init__(self, max_memory):
+        self._max_memory = max_memory
+        self._commands = []
+        self._memory = 0
+        self._file = None
+        self._file_size = 0
+        self._offsets = None
+        self._sizes = None
+        self._kinds = None
+        self._source_view = None
+        self._map = b''
+        self._map_view = memoryview(self._map)
+        self._map_size = 0
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        if self._file is None:
+            return len(self._commands)
+        return len(self._offsets)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def __getitem__(self, k):
+        if self._file is None:
+            cmd = self._commands[k]
+            if isinstance(cmd, tuple):
+                return self._source_view[cmd[0]:cmd[1]]
+            return cmd
+        offset = self._offsets[k]
+        end = offset + self._sizes[k]
+        kind = self._kinds[k]
+        if kind == _IN_SOURCE:
+            return self._source_view[offset:end]
+        if end > self._map_size:
+            self._remap()
+        if kind == _VIEW_IN_FILE:
+            return self._map_view[offset:end]
+        return self._map[offset:end]
+
+    def __setitem__(self, k, cmd):
+        if self._file is None:
+            size_diff = _memorysize(cmd) - _memorysize(self._commands[k])
+            self._commands[k] = cmd
+            self._addmemory(size_diff)
+        else:
+            # Note: The old command is left as garbage in the file.
+            (self._offsets[k], self._sizes[k], self._kinds[k]) = self._spillcommand(cmd)
+
+    def append(self, cmd):
+        if self._file is None:
+            self._commands.append(cmd)
+            self._addmemory(_memorysize(cmd))
+        else:
+            self._appendspilled(cmd)
+
+    # Append a part of a source buffer (only its position is recorded). All the
+    # parts must be from the same source buffer.
+    def appendsource(self, source_view, start, end):
+        assert(self._source_view is None or self._source_view.obj is source_view.obj)
+        self._source_view = source_view
+        self.append((start, end))
+
+    def close(self):
+        CommandStore._memory_used -= self._memory
+        self._memory = 0
+        self._commands = []
+        self._source_view = None
+        self._map_view = None
+        self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _addmemory(self, size):
+        self._memory += size
+        CommandStore._memory_used += size
+        if CommandStore._memory_used > self._max_memory:
+            self._spill()
+
+    # Move all the commands from memory to a temporary file (the parts of the
+    # source buffer stay where they are).
+    def _spill(self):
+        self._file = tempfile.TemporaryFile(prefix=_TEMP_PREFIX)
+        self._offsets = array.array(_OFFSET_TYPE)
+        self._sizes = array.array(_OFFSET_TYPE)
+        self._kinds = bytearray()
+        for cmd in self._commands:
+            self._appendspilled(cmd)
+        self._commands = []
+        CommandStore._memory_used -= self._memory
+        self._memory = 0
+
+    def _appendspilled(self, cmd):
+        (offset, size, kind) = self._spillcommand(cmd)
+        self._offsets.append(offset)
+        self._sizes.append(size)
+        self._kinds.append(kind)
+
+    # Get the location of a command in a spilled store (offset, size and kind),
+    # writing it to the file unless it is a part of the source buffer.
+    def _spillcommand(self, cmd):
+        if isinstance(cmd, tuple):
+            return (cmd[0], cmd[1] - cmd[0], _IN_SOURCE)
+        kind = _VIEW_IN_FILE if isinstance(cmd, memoryview) else _IN_FILE
+        return (self._write(cmd), len(cmd), kind)
+
+    def _write(self, cmd):
+        offset = self._file_size
+        self._file.write(cmd)
+        self._file_size += len(cmd)
+        return offset
+
+    # Map the file (again) so that all the written commands can be read.
+    def _remap(self):
+        self._file.flush()
+        if self._file_size == 0:
+            self._map = b''
+        else:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._map_view = memoryview(self._map)
+        self._map_size = self._file_size
@@ -20,7 +20,24 @@
   3. This notice may not be removed or altered from any source distribution.
 """
 
-import argparse, multiprocessing, os, shutil, subprocess, sys
+import argparse, functools, json, mmap, multiprocessing, os, shutil, subprocess, sys, tempfile, time
+from commandstore import appendsource, newcommandlist
+from optimizerepo import optimizerepo
+from profiling import newpool, setphase
+from verifyhistory import getcommitoids, readmarks, verifyhistory
+
+# Cost model (seconds per blob, seconds per byte) when there is no timing history
+# (roughly a process startup plus 10 MB/s).
+_DEFAULT_MODEL = (0.01, 1e-7)
+
+# Keys of the timing statistics (see newtimingstats()).
+_TIMING_STATS_KEYS = ['nn', 'nb', 'bb', 'nt', 'bt', 'tt']
+
+# Weight of the timing history from previous runs, relative to the current run.
+_TIMING_HISTORY_DECAY = 0.5
+
+# The memory mapped export of the source repository (in the worker processes).
+_export_map = None
 
 # Clean out a directory.
 def cleandir(path):
@@ -34,154 +51,395 @@ def cleandir(path):
         except Exception as e:
             print(e)
 
-def extractline(exp_str, pos):
-    eol_pos = exp_str.find('\n', pos)
+def extractline(exp_map, pos):
+    eol_pos = exp_map.find(b'\n', pos)
     if eol_pos >= 0:
-        return (exp_str[pos:eol_pos], eol_pos + 1)
+        return (exp_map[pos:eol_pos], eol_pos + 1)
     else:
-        return (exp_str[pos:len(exp_str)], len(exp_str))
+        return (exp_map[pos:len(exp_map)], len(exp_map))
 
-# Parse an export string into a list of commands.
-def parseexport(exp_str):
+# Parse a memory mapped export into a list of commands.
+# The payload of a 'data' command is not copied: The command is represented by a
+# memoryview of the payload in the export (the header is implied). The positions
+# of the blob payloads in the export are returned too, in a map from command
+# index to position.
+def parseexport(exp_map, max_memory):
+    exp_view = memoryview(exp_map)
     current_pos = 0
-    end_pos = len(exp_str)
-    commands = []
+    end_pos = len(exp_map)
+    commands = newcommandlist(max_memory)
+    blob_data_pos_map = {}
+    in_blob = False
     while current_pos < end_pos:
         # Get the next command.
-        (cmd, current_pos) = extractline(exp_str, current_pos)
+        (cmd, current_pos) = extractline(exp_map, current_pos)
         if cmd:
             # Get the command type.
-            space_pos = cmd.find(' ')
+            space_pos = cmd.find(b' ')
             if space_pos >= 0:
                 cmd_type = cmd[:space_pos]
             else:
                 cmd_type = cmd
 
             # Handle 'data'.
-            if cmd_type == 'data':
+            if cmd_type == b'data':
                 data_len = int(cmd[(space_pos + 1):])
                 data_end = current_pos + data_len
-                data = exp_str[current_pos:data_end]
-                cmd = cmd + '\n' + data
+                if in_blob:
+                    blob_data_pos_map[len(commands)] = current_pos
+                appendsource(commands, exp_view, current_pos, data_end)
                 current_pos = data_end
+                continue
+            elif cmd_type in [b'blob', b'commit', b'reset', b'tag']:
+                in_blob = (cmd_type == b'blob')
 
             commands.append(cmd)
 
-    return commands
+    return (commands, blob_data_pos_map)
 
-# Generate an import string.
-def makeimport(exp):
-    return '\n'.join(exp) + '\n'
+# Write an import stream.
+def writeimport(stream, commands):
+    for cmd in commands:
+        if isinstance(cmd, memoryview):
+            # Write the header and the payload of the 'data' command separately.
+            stream.write(b'data ' + str(len(cmd)).encode('utf-8') + b'\n')
+            stream.write(cmd)
+        else:
+            stream.write(cmd)
+        stream.write(b'\n')
 
-# Export a repository.
-def exportrepo(repo_root):
-    cmd = ['git', '-C', repo_root, 'fast-export', '--all']
-    return parseexport(subprocess.check_output(cmd))
+# Export a repository to a file.
+def exportrepo(repo_root, export_path):
+    cmd = ['git', '-C', repo_root, 'fast-export', '--all', '--show-original-ids']
+    with open(export_path, 'wb') as f:
+        subprocess.check_call(cmd, stdout=f)
 
-# Import to a new repository.
-def importtorepo(repo_root, commands):
-    # Generate a string from the export description.
-    import_str = makeimport(commands)
+# Memory map a file.
+def mapfile(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
+# Import to a new repository.
+def importtorepo(repo_root, commands, marks_path = None):
     # Initialize the repository.
     cmd = ['git', 'init', repo_root]
     subprocess.check_call(cmd)
 
-    # Import the fast-import string into the repo.
-    p = subprocess.Popen(['git', '-C', repo_root, 'fast-import'], stdin=subprocess.PIPE)
-    p.communicate(input=import_str)
+    # Import the fast-import stream into the repo.
+    cmd = ['git', '-C', repo_root, 'fast-import']
+    if marks_path:
+        cmd.append('--export-marks=' + os.path.abspath(marks_path))
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, bufsize=-1)
+    writeimport(p.stdin, commands)
+    p.stdin.close()
+    p.wait()
 
-def applyfilter(blob_filter_fun, file_name, blob, data_idx, progress):
-    # Print progress.
-    print '\rProgress: %.1f%%' % (progress),
-    sys.stdout.flush()
+# Initialize a worker process: Map the export, so that the blobs can be read
+# directly from it (instead of passing them through the job queue).
+def initworker(export_path):
+    global _export_map
+    _export_map = mapfile(export_path)
 
-    # Filter the blob and return the result.
-    blob = blob_filter_fun(file_name, blob)
-    return { 'data_idx': data_idx, 'blob': blob }
+# Read the blob of a filter job from the export.
+def getjobblob(job):
+    return _export_map[job['data_pos']:(job['data_pos'] + job['data_len'])]
 
-# Filter all blobs.
-def filterblobs(src_repo, dst_repo, name_filter_fun, blob_filter_fun, branch = 'master'):
-    # Export the source repository.
-    print 'Exporting the source repository (' + src_repo + ')...'
-    commands = exportrepo(src_repo)
-
-    # Filter all the data blobs.
-    print 'Filtering blobs...'
-
-    # Get a list of filter jobs to perform.
-    mark_to_blob_data_map = {}
-    jobs_map = {}
-    for i in xrange(0, len(commands)):
-        cmd = commands[i]
-        if cmd == 'blob':
-            # data blob
-            mark = commands[i + 1][5:]
-            assert(mark[0] == ':')
-            data_idx = i + 2
-            assert(commands[data_idx][:4] == 'data')
-            assert(not (mark in mark_to_blob_data_map))
-            mark_to_blob_data_map[mark] = data_idx
-        elif cmd[:2] == 'M ':
-            # filemodify
-            # Get the file name for this file.
-            parts = cmd.split(' ')
-            file_name = ' '.join(parts[3:])
-            if name_filter_fun(file_name):
-                # Append this file to the jobs.
-                mark = parts[2]
-                assert(mark[0] == ':')
-                assert(mark in mark_to_blob_data_map)
-                data_idx = mark_to_blob_data_map[mark]
-                assert(commands[data_idx][:4] == 'data')
-                if not (data_idx in jobs_map):
-                    jobs_map[data_idx] = file_name
-
-    # Perform all the jobs in parallel using a thread pool.
-    pool = multiprocessing.Pool()
+# Get the file extension of a file name (used as the file type for the timing
+# history).
+def getextension(file_name):
+    return os.path.splitext(file_name.strip('"'))[1].lower()
+
+def applyfilter(blob_filter_fun, jobs):
+    # Filter the blobs one by one and return the results. Each blob is one
+    # invocation of the filter.
+    start_time = time.time()
     results = []
-    count = 0
-    total_count = len(jobs_map)
-    for data_idx in jobs_map:
-        # Get the file name for this job.
+    invocations = []
+    for job in jobs:
+        blob_start_time = time.time()
+        results.append({ 'data_idx': job['data_idx'], 'blob': blob_filter_fun(job['file_name'], getjobblob(job)) })
+        parts = { getextension(job['file_name']): [1, job['data_len']] }
+        invocations.append((parts, time.time() - blob_start_time))
+    return { 'results': results, 'time': time.time() - start_time, 'invocations': invocations }
+
+def applybatchfilter(batch_filter_fun, jobs):
+    # Filter the blobs and return the results. The batch is one invocation of
+    # the filter.
+    start_time = time.time()
+    file_names = [job['file_name'] for job in jobs]
+    blobs = batch_filter_fun(file_names, [getjobblob(job) for job in jobs])
+    results = [{ 'data_idx': jobs[k]['data_idx'], 'blob': blobs[k] } for k in range(len(jobs))]
+    elapsed_time = time.time() - start_time
+    parts = {}
+    for job in jobs:
+        part = parts.setdefault(getextension(job['file_name']), [0, 0])
+        part[0] += 1
+        part[1] += job['data_len']
+    return { 'results': results, 'time': elapsed_time, 'invocations': [(parts, elapsed_time)] }
+
+# Replace the data commands of a filter job using the new blob data.
+def storeresult(commands, result):
+    for res in result['results']:
+        commands[res['data_idx']] = memoryview(res['blob'])
+
+# The timing statistics for a file type are the sums (over samples of a number of
+# blobs, a number of bytes and a filter time) that are needed for a least
+# squares fit of the cost model: n*n, n*b, b*b, n*t, b*t and t*t.
+def newtimingstats():
+    return dict.fromkeys(_TIMING_STATS_KEYS, 0.0)
+
+# Add a timing sample (the filter time for a number of blobs and bytes of a file
+# type) to the timing statistics.
+def addtiming(stats, ext, num_blobs, num_bytes, seconds):
+    s = stats.setdefault(ext, newtimingstats())
+    s['nn'] += num_blobs * num_blobs
+    s['nb'] += num_blobs * num_bytes
+    s['bb'] += float(num_bytes) * num_bytes
+    s['nt'] += num_blobs * seconds
+    s['bt'] += num_bytes * seconds
+    s['tt'] += seconds * seconds
+
+# Fit the cost model for a file type to its timing statistics. The filter time is
+# modelled as a fixed cost per blob (e.g. process startup) plus a cost per byte,
+# without negative costs. Returns (seconds_per_blob, seconds_per_byte).
+def fitmodel(s):
+    det = s['nn'] * s['bb'] - s['nb'] * s['nb']
+    if det > 1e-9 * s['nn'] * s['bb']:
+        seconds_per_blob = (s['nt'] * s['bb'] - s['bt'] * s['nb']) / det
+        seconds_per_byte = (s['bt'] * s['nn'] - s['nt'] * s['nb']) / det
+        if seconds_per_blob >= 0.0 and seconds_per_byte >= 0.0:
+            return (seconds_per_blob, seconds_per_byte)
+
+    # Use the single term that fits best (the sizes do not vary enough, or the
+    # full fit gave a negative cost).
+    blob_only = (s['nt'] / s['nn'], 0.0) if s['nn'] > 0 else None
+    byte_only = (0.0, s['bt'] / s['bb']) if s['bb'] > 0 else None
+    if blob_only and byte_only:
+        blob_only_residual = s['tt'] - s['nt'] * s['nt'] / s['nn']
+        byte_only_residual = s['tt'] - s['bt'] * s['bt'] / s['bb']
+        return blob_only if blob_only_residual <= byte_only_residual else byte_only
+    return blob_only or byte_only or _DEFAULT_MODEL
+
+# Get the cost models for all file types in the timing statistics, and the model
+# for other file types (the average model).
+def getmodels(stats):
+    models = dict([(ext, fitmodel(stats[ext])) for ext in stats])
+    default_model = _DEFAULT_MODEL
+    if models:
+        default_model = (sum([x[0] for x in models.values()]) / len(models),
+                         sum([x[1] for x in models.values()]) / len(models))
+    return (models, default_model)
+
+# Estimate the filter time for a number of blobs and bytes of a file type.
+def estimatecost(models, default_model, ext, num_blobs, num_bytes):
+    (seconds_per_blob, seconds_per_byte) = models.get(ext, default_model)
+    return num_blobs * seconds_per_blob + num_bytes * seconds_per_byte
+
+# Add the invocations of a filter job to the timing statistics. The time of an
+# invocation that covers several file types is split according to the
+# estimated cost of each file type.
+def addinvocations(stats, models, default_model, invocations):
+    for (parts, seconds) in invocations:
+        costs = dict([(ext, estimatecost(models, default_model, ext, parts[ext][0], parts[ext][1])) for ext in parts])
+        total_cost = sum(costs.values())
+        for ext in parts:
+            share = (costs[ext] / total_cost) if total_cost > 0 else (1.0 / len(parts))
+            addtiming(stats, ext, parts[ext][0], parts[ext][1], seconds * share)
+
+# Read the timing history: A map from file extension to timing statistics.
+def readtimings(timing_file):
+    stats = {}
+    if timing_file and os.path.isfile(timing_file):
+        with open(timing_file, 'r') as f:
+            history = json.load(f)
+        for ext in history:
+            # Skip entries that are not in the current format.
+            if isinstance(history[ext], dict) and set(history[ext]) == set(_TIMING_STATS_KEYS):
+                stats[ext] = history[ext]
+    return stats
+
+# Update the timing history with the timing statistics from this run (the older
+# history is given less weight).
+def writetimings(timing_file, history, stats):
+    for ext in history:
+        for key in _TIMING_STATS_KEYS:
+            history[ext][key] *= _TIMING_HISTORY_DECAY
+    for ext in stats:
+        s = history.setdefault(ext, newtimingstats())
+        for key in _TIMING_STATS_KEYS:
+            s[key] += stats[ext][key]
+    with open(timing_file, 'w') as f:
+        json.dump(history, f, indent=2, sort_keys=True)
+
+# Split the filter jobs into batches of up to batch_size jobs. A batch never holds
+# two jobs with the same file name.
+def makebatches(data_indices, jobs_map, batch_size):
+    batches = []
+    batch = []
+    batch_names = set()
+    for data_idx in data_indices:
         file_name = jobs_map[data_idx]
+        if len(batch) >= batch_size or file_name in batch_names:
+            batches.append(batch)
+            batch = []
+            batch_names = set()
+        batch.append(data_idx)
+        batch_names.add(file_name)
+    if batch:
+        batches.append(batch)
+    return batches
 
-        # Extract the blob data from the command list (will be replaced later).
-        cmd = commands[data_idx]
-        assert(cmd[:4] == 'data')
-        nl_idx = cmd.find('\n')
-        assert(nl_idx > 0)
-        blob = cmd[(nl_idx + 1):]
-        commands[data_idx] = '' # Save some memory.
-
-        # Increment progress...
-        count += 1
-        progress = (100.0 * count) / float(total_count)
-
-        # Perform the filter.
-        results.append(pool.apply_async(applyfilter, [blob_filter_fun, file_name, blob, data_idx, progress]))
-
-    # Wait for all jobs in the thread pool to be finished.
-    pool.close()
-    pool.join()
-
-    # Get the results. Will re-raise any exception raised in worker.
-    for result in results:
-        res = result.get()
-        blob = res['blob']
-        data_idx = res['data_idx']
-
-        # Replace the data command using the new blob data.
-        commands[data_idx] = 'data ' + str(len(blob)) + '\n' + blob
-
-    # Create the new repository and import the filtered history.
-    if os.path.isdir(dst_repo):
-        cleandir(dst_repo)
-    else:
-        os.makedirs(dst_repo)
-    print '\nImporting result to ' + os.path.abspath(dst_repo) + '...'
-    importtorepo(dst_repo, commands)
+# Filter all blobs.
+# If batch_filter_fun is given, it is used instead of blob_filter_fun for
+# filtering batches of up to batch_size blobs at a time. It is called with a list
+# of file names and a list of blobs, and returns a list of filtered blobs. A
+# batch never holds two blobs with the same file name.
+# Blobs that are larger than blob_size_limit (if given) are not filtered.
+# The jobs are scheduled most expensive first, based on a cost model (a fixed
+# cost per blob plus a cost per byte) for each file type, that is fitted to the
+# timings in timing_file (if given). The file is updated with the timings from
+# this run.
+# If verify is True, all the rewritten commits are verified against the source
+# commits (only files that pass the name filter may differ). Returns False if
+# the verification fails.
+def filterblobs(src_repo, dst_repo, name_filter_fun, blob_filter_fun, branch = 'master', max_memory = None, optimize = False,
+                batch_filter_fun = None, batch_size = 1, verify = False, timing_file = None, blob_size_limit = None):
+    (fd, export_path) = tempfile.mkstemp(prefix='git-tools-', suffix='.export')
+    os.close(fd)
+    (fd, marks_path) = tempfile.mkstemp(prefix='git-tools-', suffix='.marks')
+    os.close(fd)
+    try:
+        # Export the source repository.
+        print('Exporting the source repository (' + src_repo + ')...')
+        setphase('export')
+        exportrepo(src_repo, export_path)
+        setphase('parse')
+        (commands, blob_data_pos_map) = parseexport(mapfile(export_path), max_memory)
+
+        # Filter all the data blobs.
+        print('Filtering blobs...')
+        setphase('filter')
+
+        # Get a list of filter jobs to perform.
+        mark_to_blob_data_map = {}
+        jobs_map = {}
+        for i in range(0, len(commands)):
+            cmd = commands[i]
+            if isinstance(cmd, memoryview):
+                continue
+            if cmd == b'blob':
+                # data blob
+                mark = commands[i + 1][5:]
+                assert(mark[:1] == b':')
+                data_idx = i + 2
+                # 'original-oid' (optional) comes after 'mark'.
+                if not data_idx in blob_data_pos_map:
+                    data_idx = data_idx + 1
+                assert(data_idx in blob_data_pos_map)
+                assert(not (mark in mark_to_blob_data_map))
+                mark_to_blob_data_map[mark] = data_idx
+            elif cmd[:2] == b'M ':
+                # filemodify
+                # Get the file name for this file.
+                parts = cmd.split(b' ', 3)
+                file_name = parts[3].decode('utf-8', 'surrogateescape')
+                if name_filter_fun(file_name):
+                    # Append this file to the jobs.
+                    mark = parts[2]
+                    assert(mark[:1] == b':')
+                    assert(mark in mark_to_blob_data_map)
+                    data_idx = mark_to_blob_data_map[mark]
+                    if blob_size_limit is not None and len(commands[data_idx]) > blob_size_limit:
+                        continue
+                    if not (data_idx in jobs_map):
+                        jobs_map[data_idx] = file_name
+
+        # Estimate the cost of each job (using the cost model for the file type),
+        # and split the jobs into batches, most expensive first.
+        history = readtimings(timing_file)
+        (models, default_model) = getmodels(history)
+        job_costs = {}
+        for data_idx in jobs_map:
+            ext = getextension(jobs_map[data_idx])
+            job_costs[data_idx] = estimatecost(models, default_model, ext, 1, len(commands[data_idx]))
+        data_indices = sorted(jobs_map, key=lambda x: job_costs[x], reverse=True)
+        batches = makebatches(data_indices, jobs_map, batch_size if batch_filter_fun else 1)
+        batches.sort(key=lambda x: sum([job_costs[data_idx] for data_idx in x]), reverse=True)
+
+        # Perform all the jobs in parallel using a process pool. The workers
+        # read the blobs directly from the export. The batches are dispatched
+        # most expensive first, and each idle worker picks the next batch from
+        # the shared task queue, so that no worker is left with a long tail of
+        # work. The results are stored as soon as they are finished.
+        num_workers = multiprocessing.cpu_count()
+        pool = newpool(num_workers, initializer=initworker, initargs=[export_path])
+        if batch_filter_fun:
+            apply_fun = functools.partial(applybatchfilter, batch_filter_fun)
+        else:
+            apply_fun = functools.partial(applyfilter, blob_filter_fun)
+        all_jobs = [[{ 'file_name': jobs_map[data_idx],
+                       'data_pos': blob_data_pos_map[data_idx],
+                       'data_len': len(commands[data_idx]),
+                       'data_idx': data_idx } for data_idx in batch] for batch in batches]
+        start_time = time.time()
+        busy_time = 0.0
+        stats = {}
+        count = 0
+        total_count = len(jobs_map)
+        # Will re-raise any exception raised in worker.
+        for result in pool.imap_unordered(apply_fun, all_jobs):
+            storeresult(commands, result)
+            busy_time += result['time']
+            addinvocations(stats, models, default_model, result['invocations'])
+
+            # Print progress.
+            count += len(result['results'])
+            print('\rProgress: %.1f%%' % ((100.0 * count) / float(total_count)), end='')
+            sys.stdout.flush()
+
+        # Wait for all jobs in the process pool to be finished.
+        pool.close()
+        pool.join()
+
+        # Report the core utilization.
+        wall_time = time.time() - start_time
+        utilization = busy_time / (wall_time * num_workers) if wall_time > 0 else 1.0
+        print('\nFilter time: %.1f s (%.1f s of work on %d workers, %.0f%% utilization)' %
+              (wall_time, busy_time, num_workers, 100.0 * utilization))
+        if timing_file:
+            writetimings(timing_file, history, stats)
+
+        # Create the new repository and import the filtered history.
+        setphase('import')
+        if os.path.isdir(dst_repo):
+            cleandir(dst_repo)
+        else:
+            os.makedirs(dst_repo)
+        print('Importing result to ' + os.path.abspath(dst_repo) + '...')
+        importtorepo(dst_repo, commands, marks_path if verify else None)
+
+        # Checkout the tip of the main branch.
+        subprocess.check_call(['git', '-C', dst_repo, 'reset', '--hard', branch])
+
+        if optimize:
+            setphase('optimize')
+            optimizerepo(dst_repo)
 
-    # Checkout the tip of the main branch.
-    subprocess.check_call(['git', '-C', dst_repo, 'reset', '--hard', branch])
+        # Verify the rewritten commits against the source commits.
+        if verify:
+            setphase('verify')
+            marks = readmarks(marks_path)
+            oid_map = {}
+            jobs = []
+            for (mark, original_oid) in getcommitoids(commands):
+                oid_map[original_oid] = marks[mark]
+                jobs.append((src_repo, original_oid, dst_repo, marks[mark], b''))
+            config = { 'oid_map': oid_map, 'allowed_change_fun': name_filter_fun, 'ignore_root_names': [] }
+            return verifyhistory(jobs, config)
+    finally:
+        os.unlink(export_path)
+        os.unlink(marks_path)
 
+    return True
@@ -0,0 +1,68 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+"""
+  Copyright (C) 2017 Marcus Geelnard
+
+  This software is provided 'as-is', without any express or implied
+  warranty.  In no event will the authors be held liable for any damages
+  arising from the use of this software.
+
+  Permission is granted to anyone to use this software for any purpose,
+  including commercial applications, and to alter it and redistribute it
+  freely, subject to the following restrictions:
+
+  1. The origin of this software must not be misrepresented; you must not
+     claim that you wrote the original software. If you use this software
+     in a product, an acknowledgment in the product documentation would be
+     appreciated but is not required.
+  2. Altered source versions must be plainly marked as such, and must not be
+     misrepresented as being the original software.
+  3. This notice may not be removed or altered from any source distribution.
+"""
+
+import os, subprocess, time
+
+# Delta compression settings for the repack. Only the window is larger than the
+# Git default (10), since the repack is only done once for a newly generated
+# repository. The depth is kept at the Git default, since longer delta chains
+# make the objects slower to read.
+_REPACK_WINDOW = 250
+_REPACK_DEPTH = 50
+
+# Get the size of the object store of a repository (in bytes).
+def getobjectsize(repo_root):
+    out = subprocess.check_output(['git', '-C', repo_root, 'count-objects', '-v'])
+    size = 0
+    for line in out.decode('utf-8').splitlines():
+        (key, value) = line.split(': ')
+        if key in ['size', 'size-pack']:
+            size += int(value) * 1024
+    return size
+
+# Time a walk of the full commit history (in seconds).
+def timehistorywalk(repo_root):
+    start_time = time.time()
+    with open(os.devnull, 'wb') as devnull:
+        subprocess.check_call(['git', '-C', repo_root, 'rev-list', '--all', '--count'], stdout=devnull)
+    return time.time() - start_time
+
+# Optimize a newly generated repository, so that it is fast to serve: Repack all
+# objects with tuned delta settings (using all CPUs), and write reachability
+# bitmaps and a commit-graph.
+def optimizerepo(repo_root):
+    print('\nOptimizing ' + os.path.abspath(repo_root) + '...')
+    size_before = getobjectsize(repo_root)
+    walk_time_before = timehistorywalk(repo_root)
+
+    start_time = time.time()
+    subprocess.check_call(['git', '-C', repo_root, 'repack', '-a', '-d', '-f',
+                           '--window=' + str(_REPACK_WINDOW), '--depth=' + str(_REPACK_DEPTH),
+                           '--threads=0', '--write-bitmap-index'])
+    subprocess.check_call(['git', '-C', repo_root, 'commit-graph', 'write', '--reachable'])
+    optimize_time = time.time() - start_time
+
+    size_after = getobjectsize(repo_root)
+    walk_time_after = timehistorywalk(repo_root)
+
+    print('Object store size: %.1f MiB -> %.1f MiB' % (size_before / 1048576.0, size_after / 1048576.0))
+    print('History walk time: %.3f s -> %.3f s' % (walk_time_before, walk_time_after))
+    print('Optimization time: %.1f s' % (optimize_time))
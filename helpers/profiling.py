@@ -0,0 +1,115 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+"""
+  Copyright (C) 2017 Marcus Geelnard
+
+  This software is provided 'as-is', without any express or implied
+  warranty.  In no event will the authors be held liable for any damages
+  arising from the use of this software.
+
+  Permission is granted to anyone to use this software for any purpose,
+  including commercial applications, and to alter it and redistribute it
+  freely, subject to the following restrictions:
+
+  1. The origin of this software must not be misrepresented; you must not
+     claim that you wrote the original software. If you use this software
+     in a product, an acknowledgment in the product documentation would be
+     appreciated but is not required.
+  2. Altered source versions must be plainly marked as such, and must not be
+     misrepresented as being the original software.
+  3. This notice may not be removed or altered from any source distribution.
+"""
+
+import cProfile, glob, multiprocessing, multiprocessing.util, os, pstats
+
+# Number of functions to list per process kind and phase in the summary.
+_SUMMARY_FUNCTIONS = 25
+
+# Name of the summary file in the profile directory.
+_SUMMARY_FILE = 'summary.txt'
+
+# The profile directory (None if profiling is disabled).
+_profile_dir = None
+
+# The phases of the run (in order), and the parent process profiler for each
+# phase.
+_phases = []
+_profilers = {}
+_current_phase = None
+
+# Enable profiling. The profiles are written to profile_dir.
+def initprofiling(profile_dir):
+    global _profile_dir
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    for path in glob.glob(os.path.join(profile_dir, '*.prof')):
+        os.unlink(path)
+    _profile_dir = profile_dir
+
+# Start a new phase of the run (e.g. 'export' or 'filter'). The parent process is
+# profiled separately per phase (a phase that is started again accumulates).
+def setphase(phase):
+    global _current_phase
+    if _profile_dir is None:
+        return
+    if _current_phase is not None:
+        _profilers[_current_phase].disable()
+    if not phase in _profilers:
+        _phases.append(phase)
+        _profilers[phase] = cProfile.Profile()
+    _current_phase = phase
+    _profilers[phase].enable()
+
+def dumpworkerprofile(profiler, path):
+    profiler.disable()
+    profiler.dump_stats(path)
+
+def initprofiledworker(profile_dir, phase, initializer, initargs):
+    # Profile the worker process until it exits.
+    profiler = cProfile.Profile()
+    path = os.path.join(profile_dir, '%s.worker-%d.prof' % (phase, os.getpid()))
+    multiprocessing.util.Finalize(None, dumpworkerprofile, args=(profiler, path), exitpriority=10)
+    profiler.enable()
+    if initializer:
+        initializer(*initargs)
+
+# Create a process pool. If profiling is enabled, every worker is profiled (as
+# part of the current phase), and the profile is written when the worker exits.
+# Note: The pool must be closed and joined (not terminated) for the worker
+# profiles to be written.
+def newpool(processes = None, initializer = None, initargs = ()):
+    if _profile_dir is None:
+        return multiprocessing.Pool(processes, initializer=initializer, initargs=initargs)
+    return multiprocessing.Pool(processes, initializer=initprofiledworker,
+                                initargs=[_profile_dir, _current_phase, initializer, initargs])
+
+def writestats(f, title, stats, sort_key):
+    f.write('-- %s: %.3f s --\n' % (title, stats.total_tt))
+    stats.sort_stats(sort_key).print_stats(_SUMMARY_FUNCTIONS)
+
+# Stop profiling, write the parent process profiles, merge the worker profiles
+# per phase, and write a summary of the hot functions per phase.
+def finishprofiling():
+    global _current_phase
+    if _profile_dir is None:
+        return
+    if _current_phase is not None:
+        _profilers[_current_phase].disable()
+        _current_phase = None
+
+    summary_path = os.path.join(_profile_dir, _SUMMARY_FILE)
+    with open(summary_path, 'w') as f:
+        for phase in _phases:
+            f.write('==== Phase: %s ====\n\n' % (phase))
+
+            # The parent process.
+            parent_path = os.path.join(_profile_dir, phase + '.parent.prof')
+            _profilers[phase].dump_stats(parent_path)
+            writestats(f, 'Parent process (by cumulative time)', pstats.Stats(parent_path, stream=f), 'cumulative')
+
+            # The worker processes (merged).
+            worker_paths = sorted(glob.glob(os.path.join(_profile_dir, phase + '.worker-*.prof')))
+            if worker_paths:
+                stats = pstats.Stats(*worker_paths, stream=f)
+                stats.dump_stats(os.path.join(_profile_dir, phase + '.workers.prof'))
+                writestats(f, 'Worker processes, %d merged (by internal time)' % (len(worker_paths)), stats, 'tottime')
+    print('\nProfile summary written to ' + os.path.abspath(summary_path))
@@ -0,0 +1,238 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+"""
+  Copyright (C) 2017 Marcus Geelnard
+
+  This software is provided 'as-is', without any express or implied
+  warranty.  In no event will the authors be held liable for any damages
+  arising from the use of this software.
+
+  Permission is granted to anyone to use this software for any purpose,
+  including commercial applications, and to alter it and redistribute it
+  freely, subject to the following restrictions:
+
+  1. The origin of this software must not be misrepresented; you must not
+     claim that you wrote the original software. If you use this software
+     in a product, an acknowledgment in the product documentation would be
+     appreciated but is not required.
+  2. Altered source versions must be plainly marked as such, and must not be
+     misrepresented as being the original software.
+  3. This notice may not be removed or altered from any source distribution.
+"""
+
+import multiprocessing, subprocess
+from profiling import newpool
+
+# Number of shards per CPU (more shards than workers evens out the load).
+_SHARDS_PER_CPU = 4
+
+# Maximum number of mismatches to print.
+_MAX_REPORTED_MISMATCHES = 50
+
+# Tree entry mode for sub trees.
+_TREE_MODE = b'40000'
+
+# Escape sequences used by Git for C-style quoted paths.
+_QUOTE_ESCAPES = { 7: b'\\a', 8: b'\\b', 9: b'\\t', 10: b'\\n', 11: b'\\v', 12: b'\\f', 13: b'\\r',
+                   34: b'\\"', 92: b'\\\\' }
+
+# The verification configuration (in the worker processes).
+_verify_config = None
+
+# Long running 'git cat-file --batch' processes, per repository (in the worker
+# processes).
+_cat_file_procs = {}
+
+# Read a marks file (as written by 'git fast-import --export-marks') into a map
+# from mark (':N') to SHA.
+def readmarks(marks_path):
+    marks = {}
+    with open(marks_path, 'rb') as f:
+        for line in f:
+            (mark, sha) = line.split()
+            marks[mark] = sha
+    return marks
+
+# Get the mark and the original SHA of all commits in a command list.
+def getcommitoids(commands):
+    commits = []
+    in_commit = False
+    mark = b''
+    for cmd in commands:
+        if isinstance(cmd, memoryview):
+            continue
+        if cmd[:7] == b'commit ':
+            in_commit = True
+            mark = b''
+        elif in_commit and cmd[:5] == b'mark ':
+            mark = cmd[5:]
+        elif in_commit and cmd[:13] == b'original-oid ':
+            commits.append((mark, cmd[13:]))
+            in_commit = False
+        elif cmd[:5] != b'mark ':
+            in_commit = False
+    return commits
+
+# Get the representation of a path in a fast-export stream (C-style quoted if
+# necessary).
+def exportpath(path):
+    if not any([(c < 0x20 or c >= 0x7f or c in _QUOTE_ESCAPES) for c in bytearray(path)]):
+        if b' ' in path:
+            path = b'"' + path + b'"'
+        return path.decode('utf-8', 'surrogateescape')
+    quoted = bytearray(b'"')
+    for c in bytearray(path):
+        if c in _QUOTE_ESCAPES:
+            quoted += _QUOTE_ESCAPES[c]
+        elif c < 0x20 or c >= 0x7f:
+            quoted += ('\\%03o' % (c)).encode('ascii')
+        else:
+            quoted.append(c)
+    quoted += b'"'
+    return quoted.decode('ascii')
+
+def initverifier(config):
+    global _verify_config
+    _verify_config = config
+
+# Read an object from a repository. Returns (None, None) if it does not exist.
+def readobject(repo_root, rev):
+    p = _cat_file_procs.get(repo_root)
+    if p is None:
+        p = subprocess.Popen(['git', '-C', repo_root, 'cat-file', '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        _cat_file_procs[repo_root] = p
+    p.stdin.write(rev + b'\n')
+    p.stdin.flush()
+    header = p.stdout.readline().split()
+    if len(header) != 3:
+        return (None, None)
+    data = p.stdout.read(int(header[2]))
+    p.stdout.read(1)
+    return (header[1], data)
+
+# Parse a commit object.
+def parsecommit(data):
+    (headers, message) = data.split(b'\n\n', 1) if b'\n\n' in data else (data, b'')
+    commit = { 'tree': b'', 'parents': [], 'author': b'', 'committer': b'', 'message': message }
+    for line in headers.split(b'\n'):
+        space_pos = line.find(b' ')
+        key = line[:space_pos]
+        value = line[(space_pos + 1):]
+        if key == b'parent':
+            commit['parents'].append(value)
+        elif key in [b'tree', b'author', b'committer']:
+            commit[key.decode('utf-8')] = value
+    return commit
+
+# Read a tree object into a map from name to (mode, SHA).
+def readtree(repo_root, sha):
+    (obj_type, data) = readobject(repo_root, sha)
+    entries = {}
+    if obj_type != b'tree':
+        return entries
+    pos = 0
+    while pos < len(data):
+        space_pos = data.find(b' ', pos)
+        nul_pos = data.find(b'\0', space_pos)
+        mode = data[pos:space_pos]
+        name = data[(space_pos + 1):nul_pos]
+        entries[name] = (mode, data[(nul_pos + 1):(nul_pos + 21)].hex().encode('ascii'))
+        pos = nul_pos + 21
+    return entries
+
+# Compare two trees (recursively), and report any differences.
+def comparetrees(src_repo, src_tree, dst_repo, dst_tree, path, ignore_names, mismatches):
+    if src_tree == dst_tree:
+        return
+    src_entries = readtree(src_repo, src_tree)
+    dst_entries = readtree(dst_repo, dst_tree)
+    for name in sorted(set(src_entries) | set(dst_entries)):
+        if name in ignore_names:
+            continue
+        entry_path = path + name
+        if not name in dst_entries:
+            mismatches.append('missing file: ' + entry_path.decode('utf-8', 'replace'))
+        elif not name in src_entries:
+            mismatches.append('unexpected file: ' + entry_path.decode('utf-8', 'replace'))
+        else:
+            (src_mode, src_sha) = src_entries[name]
+            (dst_mode, dst_sha) = dst_entries[name]
+            if src_mode != dst_mode:
+                mismatches.append('mode differs: ' + entry_path.decode('utf-8', 'replace'))
+            elif src_sha != dst_sha:
+                if src_mode == _TREE_MODE:
+                    comparetrees(src_repo, src_sha, dst_repo, dst_sha, entry_path + b'/', [], mismatches)
+                else:
+                    allowed_change_fun = _verify_config['allowed_change_fun']
+                    if not (allowed_change_fun and allowed_change_fun(exportpath(entry_path))):
+                        mismatches.append('content differs: ' + entry_path.decode('utf-8', 'replace'))
+
+# Verify a rewritten commit against its source commit.
+def verifycommit(src_repo, src_sha, dst_repo, dst_sha, subdir):
+    mismatches = []
+    (src_type, src_data) = readobject(src_repo, src_sha)
+    (dst_type, dst_data) = readobject(dst_repo, dst_sha)
+    if src_type != b'commit' or dst_type != b'commit':
+        return ['missing commit']
+    src_commit = parsecommit(src_data)
+    dst_commit = parsecommit(dst_data)
+
+    # Compare the metadata.
+    for key in ['author', 'committer', 'message']:
+        if src_commit[key] != dst_commit[key]:
+            mismatches.append(key + ' differs')
+    oid_map = _verify_config['oid_map']
+    if oid_map is not None:
+        if [oid_map.get(x, b'') for x in src_commit['parents']] != dst_commit['parents']:
+            mismatches.append('parents differ')
+
+    # Compare the trees (the source tree may be in a subdirectory of the
+    # rewritten tree).
+    dst_tree = dst_commit['tree']
+    ignore_names = []
+    if subdir:
+        dst_entries = readtree(dst_repo, dst_tree)
+        if not subdir in dst_entries:
+            return mismatches + ['missing subdirectory: ' + subdir.decode('utf-8', 'replace')]
+        dst_tree = dst_entries[subdir][1]
+        ignore_names = _verify_config['ignore_root_names']
+    comparetrees(src_repo, src_commit['tree'], dst_repo, dst_tree, b'', ignore_names, mismatches)
+
+    return mismatches
+
+def verifyshard(jobs):
+    mismatches = []
+    for (src_repo, src_sha, dst_repo, dst_sha, subdir) in jobs:
+        for mismatch in verifycommit(src_repo, src_sha, dst_repo, dst_sha, subdir):
+            mismatches.append(src_sha.decode('ascii') + ' -> ' + dst_sha.decode('ascii') + ': ' + mismatch)
+    return mismatches
+
+# Verify rewritten commits against their source commits, in parallel.
+# Each job is a tuple (src_repo, src_sha, dst_repo, dst_sha, subdir), where
+# subdir is the subdirectory of the rewritten tree that should match the source
+# tree (empty for the root). The config holds:
+#   oid_map            - Map from source SHA to rewritten SHA, used for checking
+#                        the parents (None to skip the check).
+#   allowed_change_fun - Function that tells if the content of a file is allowed
+#                        to differ, given its path as it appears in a fast-export
+#                        stream (None if no changes are allowed).
+#   ignore_root_names  - Names to ignore in the root of the source tree, when a
+#                        subdir is given.
+# Returns True if all the commits match.
+def verifyhistory(jobs, config):
+    print('\nVerifying %d commits...' % (len(jobs)))
+    num_shards = _SHARDS_PER_CPU * multiprocessing.cpu_count()
+    shard_size = max(1, (len(jobs) + num_shards - 1) // num_shards)
+    pool = newpool(initializer=initverifier, initargs=[config])
+    results = [pool.apply_async(verifyshard, [jobs[k:(k + shard_size)]]) for k in range(0, len(jobs), shard_size)]
+    mismatches = []
+    for result in results:
+        mismatches.extend(result.get())
+    pool.close()
+    pool.join()
+
+    for mismatch in mismatches[:_MAX_REPORTED_MISMATCHES]:
+        print('  ' + mismatch)
+    if len(mismatches) > _MAX_REPORTED_MISMATCHES:
+        print('  ...')
+    print('Verified %d commits: %d mismatches' % (len(jobs), len(mismatches)))
+    return len(mismatches) == 0
@@ -20,7 +20,26 @@
   3. This notice may not be removed or altered from any source distribution.
 """
 
-import argparse, os, shutil, subprocess
+import argparse, glob, hashlib, json, os, shutil, subprocess, sys, tempfile, time
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'helpers'))
+from commandstore import checkoutput, newcommandlist, parsesize, readfile
+from optimizerepo import optimizerepo
+from profiling import finishprofiling, initprofiling, setphase
+from verifyhistory import getcommitoids, readmarks, verifyhistory
+
+# Version of the export cache format (bump when the rewrite rules change).
+_CACHE_VERSION = 1
+
+# File change commands (replaced by the wrapped root tree in the object engine).
+_FILE_CHANGE_COMMANDS = [b'M', b'D', b'C', b'R', b'deleteall']
+
+# SHA of the empty tree.
+_EMPTY_TREE = b'4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+# Ref namespace for the source objects that are copied to the new repository by
+# the object engine.
+_OBJECTS_REF_PREFIX = 'refs/join-git-repos/'
 
 # Clean out a directory.
 def cleandir(path):
@@ -64,61 +83,349 @@ def extractline(exp_str, pos):
     else:
         return (exp_str[pos:len(exp_str)], len(exp_str))
 
+# Add an offset to a mark reference (':N').
+def offsetmark(mark, mark_offset):
+    return b':' + str(int(mark[1:]) + mark_offset).encode('utf-8')
+
 # Parse an export string into a list of commands.
-def parseexport(exp_str):
+# All the rewrites that are needed for joining the repository are applied while
+# parsing, so that each command is only touched once:
+#  - All files are moved to a subdirectory (unless subdir is empty).
+#  - All refs are renamed (a suffix is added).
+#  - All marks are renumbered (an offset is added).
+# The returned repository description also holds the maximum mark number and
+# the log of the main branch (first-parent traversal).
+# If a tree map is given (for a stream that is exported with --no-data), the file
+# changes of each commit are replaced by the commands that the map holds for the
+# original commit SHA.
+def parseexport(exp_str, subdir, ref_suffix, mark_offset, branch, repo_id, max_memory, tree_map = None):
+    if subdir and subdir[-1:] != b'/':
+        subdir += b'/'
+    ref_names = [b'refs/heads/' + branch, b'refs/heads/origin/' + branch]
+
     current_pos = 0
     end_pos = len(exp_str)
-    commands = []
+    commands = newcommandlist(max_memory)
+    max_mark = mark_offset
+    found_gitmodules = False
+    mark_to_data_idx_map = {}
+    prefixed_gitmodules = set()
+    commit_info = {}
+    tip_mark = b''
+
+    # State of the current top level command ('blob', 'commit', 'tag', ...).
+    top_cmd_type = b''
+    top_mark = b''
+    top_is_tip = False
+    top_oid = b''
+    parent_mark = b''
+    time_stamp = 0.0
+
     while current_pos < end_pos:
         # Get the next command.
         (cmd, current_pos) = extractline(exp_str, current_pos)
-        if cmd:
-            # Get the command type.
-            space_pos = cmd.find(b' ')
-            if space_pos >= 0:
-                cmd_type = cmd[:space_pos]
+        if not cmd:
+            continue
+
+        # Get the command type.
+        space_pos = cmd.find(b' ')
+        if space_pos >= 0:
+            cmd_type = cmd[:space_pos]
+        else:
+            cmd_type = cmd
+
+        # Drop the file changes if they are replaced by the tree map.
+        if tree_map is not None and cmd_type in _FILE_CHANGE_COMMANDS:
+            continue
+
+        # Handle 'data'.
+        if cmd_type == b'data':
+            data_len = int(cmd[(space_pos + 1):].decode('utf-8'))
+            data_end = current_pos + data_len
+            data = exp_str[current_pos:data_end]
+            cmd = cmd + b'\n' + data
+            current_pos = data_end
+
+            # Pick up data blobs (for .gitmodules).
+            if top_cmd_type == b'blob':
+                mark_to_data_idx_map[top_mark] = len(commands)
+
+        # Commands that reference paths: 'M', 'D', 'C' and 'R'.
+        elif cmd_type == b'M':
+            parts = cmd.split(b' ', 3)
+            mark = parts[2]
+            if mark_offset and mark[:1] == b':':
+                mark = offsetmark(mark, mark_offset)
+            path = parts[3]
+            if subdir:
+                if path == b'.gitmodules':
+                    # Only rewrite each blob once (it may be referenced again
+                    # if the file is reverted to an earlier version).
+                    if not mark in prefixed_gitmodules:
+                        data_idx = mark_to_data_idx_map[mark]
+                        commands[data_idx] = prefixgitsubmodules(subdir, commands[data_idx])
+                        prefixed_gitmodules.add(mark)
+                    found_gitmodules = True
+                else:
+                    path = prefixpath(subdir, path)
+            if subdir or mark_offset:
+                cmd = b' '.join(parts[:2]) + b' ' + mark + b' ' + path
+        elif cmd_type == b'D':
+            if subdir:
+                path = cmd[2:]
+                if path == b'.gitmodules':
+                    found_gitmodules = True
+                else:
+                    cmd = cmd[:2] + prefixpath(subdir, path)
+        elif cmd_type == b'C' or cmd_type == b'R':
+            if subdir:
+                if cmd[2:3] == b'"':
+                    src_end = cmd.find(b'"', 3)
+                    # TODO(m): Support escaped quotes.
+                    assert(src_end >= 0 and cmd[(src_end - 1):src_end] != b'\\')
+                else:
+                    src_end = cmd.find(b' ', 3) - 1
+                    assert(src_end >= 0)
+                src_path = prefixpath(subdir, cmd[2:(src_end + 1)])
+                dst_path = prefixpath(subdir, cmd[(src_end + 2):])
+                cmd = cmd_type + b' ' + src_path + b' ' + dst_path
+
+        # Handle 'mark', 'from' and 'merge'.
+        elif cmd_type == b'mark':
+            mark = cmd[5:]
+            if mark_offset:
+                mark = offsetmark(mark, mark_offset)
+                cmd = b'mark ' + mark
+            mark_num = int(mark[1:])
+            if mark_num > max_mark:
+                max_mark = mark_num
+            top_mark = mark
+            if top_is_tip and top_cmd_type == b'commit':
+                tip_mark = mark
+        elif cmd_type == b'from' or cmd_type == b'merge':
+            mark = cmd[(space_pos + 1):]
+            if mark[:1] == b':':
+                if mark_offset:
+                    mark = offsetmark(mark, mark_offset)
+                    cmd = cmd_type + b' ' + mark
+                if cmd_type == b'from':
+                    if top_cmd_type == b'commit':
+                        parent_mark = mark
+                    elif top_is_tip and top_cmd_type == b'reset':
+                        tip_mark = mark
+
+        # Handle 'N'.
+        elif cmd_type == b'N':
+            if mark_offset:
+                parts = cmd.split(b' ', 2)
+                if parts[1][:1] == b':':
+                    parts[1] = offsetmark(parts[1], mark_offset)
+                if parts[2][:1] == b':':
+                    parts[2] = offsetmark(parts[2], mark_offset)
+                cmd = b' '.join(parts)
+
+        # Collect the commit time (used for stitching the logs).
+        elif cmd_type == b'committer':
+            if top_cmd_type == b'commit':
+                time_stamp = extracttimestamp(cmd)
+        elif cmd_type == b'original-oid':
+            top_oid = cmd[13:]
+
+        # Handle the top level commands.
+        elif cmd_type in [b'blob', b'commit', b'reset', b'tag']:
+            # Finish the previous commit.
+            if top_cmd_type == b'commit':
+                commit_info[top_mark] = (time_stamp, parent_mark)
+                if tree_map is not None:
+                    for tree_cmd in tree_map[top_oid]:
+                        commands.append(tree_cmd)
+
+            # Rename refs ('commit', 'reset' and 'tag').
+            if cmd_type != b'blob':
+                cmd = cmd.replace(b'refs/remotes/origin/', b'refs/heads/', 1)
+                top_is_tip = (cmd_type != b'tag') and (cmd[(space_pos + 1):] in ref_names)
+                if ref_suffix:
+                    cmd = cmd + ref_suffix
             else:
-                cmd_type = cmd
+                top_is_tip = False
 
-            # Handle 'data'.
-            if cmd_type == b'data':
-                data_len = int(cmd[(space_pos + 1):].decode('utf-8'))
-                data_end = current_pos + data_len
-                data = exp_str[current_pos:data_end]
-                cmd = cmd + b'\n' + data
-                current_pos = data_end
+            top_cmd_type = cmd_type
+            top_mark = b''
+            parent_mark = b''
 
-            commands.append(cmd)
+        commands.append(cmd)
 
-    return commands
+    # Finish the last commit.
+    if top_cmd_type == b'commit':
+        commit_info[top_mark] = (time_stamp, parent_mark)
+        if tree_map is not None:
+            for tree_cmd in tree_map[top_oid]:
+                commands.append(tree_cmd)
 
-# Generate an import string.
-def makeimport(exp):
-    return b'\n'.join(exp) + b'\n'
+    # Get the log for the main branch (first-parent traversal), starting at the
+    # tip of the branch and walking backwards.
+    log = []
+    mark = tip_mark
+    while mark in commit_info:
+        (time_stamp, parent_mark) = commit_info[mark]
+        log.append({ 'mark': b'mark ' + mark, 'time': time_stamp, 'id': repo_id })
+        mark = parent_mark
+
+    # Return the reversed log (oldest commit first).
+    return { 'commands': commands,
+             'log': log[::-1],
+             'max_mark': max_mark,
+             'found_gitmodules': found_gitmodules }
+
+# Write an import stream.
+def writeimport(stream, commands):
+    for cmd in commands:
+        stream.write(cmd)
+        stream.write(b'\n')
+
+# Get the cache file name prefix for a repository, and the key for its current
+# state. The prefix identifies the repository and how it is rewritten, and the
+# key identifies the state of all its refs.
+def getcachekey(repo_spec, move_to_subdir, ref_suffix):
+    source = [_CACHE_VERSION, os.path.abspath(repo_spec['path']), repo_spec['name'],
+              repo_spec['branch'], move_to_subdir, ref_suffix.decode('utf-8')]
+    prefix = hashlib.sha1(json.dumps(source).encode('utf-8')).hexdigest()
+    cmd = ['git', '-C', repo_spec['path'], 'for-each-ref', '--format=%(objectname) %(refname)']
+    key = hashlib.sha1(subprocess.check_output(cmd)).hexdigest()
+    return (prefix, key)
 
 # Export a repository.
-def exportrepo(repo_root):
-    cmd = ['git', '-C', repo_root, 'fast-export', '--all', '--show-original-ids']
-    return parseexport(subprocess.check_output(cmd))
+def exportrepo(repo_spec, move_to_subdir, ref_suffix, mark_offset, repo_id, max_memory, cache_dir = None):
+    cmd = ['git', '-C', repo_spec['path'], 'fast-export', '--all', '--show-original-ids']
+    subdir = repo_spec['name'].encode('utf-8') if move_to_subdir else b''
+    branch = repo_spec['branch'].encode('utf-8')
+    if not cache_dir:
+        return parseexport(checkoutput(cmd, max_memory), subdir, ref_suffix, mark_offset, branch, repo_id, max_memory)
+
+    # The cache holds the rewritten (moved to the subdir, with renamed refs and
+    # renumbered marks) export, and the mark offset that it was written with.
+    (prefix, key) = getcachekey(repo_spec, move_to_subdir, ref_suffix)
+    cache_base = os.path.join(cache_dir, prefix + '-' + key)
+    if os.path.isfile(cache_base + '.json'):
+        # Load the cached export. The refs already have the suffix, and the
+        # paths are already moved to the subdir, so only the marks may have to
+        # be renumbered (if the offset has changed).
+        print('Using cached export (' + cache_base + '.export)')
+        with open(cache_base + '.json', 'r') as f:
+            info = json.load(f)
+        mark_delta = mark_offset - info.get('mark_offset', 0)
+        repo = parseexport(readfile(cache_base + '.export', max_memory), b'', b'', mark_delta, branch + ref_suffix, repo_id, max_memory)
+        repo['max_mark'] = max(repo['max_mark'], mark_offset)
+        repo['found_gitmodules'] = info['found_gitmodules']
+        return repo
+
+    repo = parseexport(checkoutput(cmd, max_memory), subdir, ref_suffix, mark_offset, branch, repo_id, max_memory)
+
+    # Remove old cache entries for this repository.
+    for path in glob.glob(os.path.join(cache_dir, prefix + '-*')):
+        os.unlink(path)
+
+    # Write the new cache entry (the .json file is written last, to mark the
+    # entry as complete).
+    with open(cache_base + '.export', 'wb') as f:
+        writeimport(f, repo['commands'])
+    with open(cache_base + '.json', 'w') as f:
+        json.dump({ 'found_gitmodules': repo['found_gitmodules'], 'mark_offset': mark_offset }, f)
+    return repo
+
+# Get the file change commands that put the root tree of each commit of a
+# repository in a subdirectory (object engine). The commands are applied on top of
+# the tree of the (stitched) first parent, so the subdirectories of the other
+# repositories are kept. Returns a map from commit SHA to commands, and whether
+# any of the trees has a .gitmodules file. The commands are memoized per tree,
+# since many commits share the same tree.
+def gettreemap(repo_root, subdir):
+    out = subprocess.check_output(['git', '-C', repo_root, 'log', '--all', '--pretty=format:%H %T'])
+    commit_trees = [line.split(b' ') for line in out.splitlines()]
+    trees = sorted(set([x[1] for x in commit_trees]))
+
+    # Look up the .gitmodules blob of each tree (if any).
+    cmd = ['git', '-C', repo_root, 'cat-file', '--batch-check=%(objectname) %(objecttype)']
+    out = subprocess.check_output(cmd, input=b''.join([(x + b':.gitmodules\n') for x in trees]))
+    gitmodules = {}
+    for (tree, line) in zip(trees, out.splitlines()):
+        parts = line.split(b' ')
+        if parts[-1] == b'blob':
+            gitmodules[tree] = parts[0]
+    found_gitmodules = len(gitmodules) > 0
+
+    # Rewrite each .gitmodules blob once.
+    gitmodules_data = {}
+    for blob in set(gitmodules.values()):
+        data = subprocess.check_output(['git', '-C', repo_root, 'cat-file', 'blob', blob.decode('ascii')])
+        gitmodules_data[blob] = prefixgitsubmodules(subdir + b'/', b'data ' + str(len(data)).encode('utf-8') + b'\n' + data)
+
+    tree_cmds = {}
+    for tree in trees:
+        if tree == _EMPTY_TREE:
+            cmds = [b'D ' + subdir]
+        else:
+            cmds = [b'M 040000 ' + tree + b' ' + subdir]
+        if found_gitmodules:
+            if tree in gitmodules:
+                # Move .gitmodules to the root (as in the stream engine).
+                cmds += [b'D ' + subdir + b'/.gitmodules',
+                         b'M 100644 inline .gitmodules', gitmodules_data[gitmodules[tree]]]
+            else:
+                cmds.append(b'D .gitmodules')
+        tree_cmds[tree] = cmds
+
+    return ({ x[0]: tree_cmds[x[1]] for x in commit_trees }, found_gitmodules)
+
+# Export the commit history of a repository, without any file data (object
+# engine). Instead of moving every file to the subdirectory, the file changes of
+# each commit are replaced by the root tree of the commit, wrapped in the
+# subdirectory (the trees and blobs are copied to the new repository as is, see
+# copyobjects()).
+def exportrepoobjects(repo_spec, ref_suffix, mark_offset, repo_id, max_memory):
+    subdir = repo_spec['name'].encode('utf-8')
+    branch = repo_spec['branch'].encode('utf-8')
+    (tree_map, found_gitmodules) = gettreemap(repo_spec['path'], subdir)
+    cmd = ['git', '-C', repo_spec['path'], 'fast-export', '--all', '--no-data', '--show-original-ids']
+    repo = parseexport(checkoutput(cmd, max_memory), b'', ref_suffix, mark_offset, branch, repo_id, max_memory, tree_map)
+    repo['found_gitmodules'] = found_gitmodules
+    return repo
+
+# Copy all the objects of the source repositories to a new repository (object
+# engine). The objects are fetched to temporary refs, see removecopiedrefs().
+def copyobjects(repo_root, repo_specs):
+    subprocess.check_call(['git', 'init', '--quiet', repo_root])
+    for k in range(len(repo_specs)):
+        refspec = '+refs/*:' + _OBJECTS_REF_PREFIX + str(k) + '/*'
+        cmd = ['git', '-C', repo_root, 'fetch', '--quiet', '--no-tags', os.path.abspath(repo_specs[k]['path']), refspec]
+        subprocess.check_call(cmd)
+
+# Remove the temporary refs for the copied objects (the source commits are left
+# unreachable, and are removed by git gc).
+def removecopiedrefs(repo_root):
+    cmd = ['git', '-C', repo_root, 'for-each-ref', '--format=delete %(refname)', _OBJECTS_REF_PREFIX]
+    refs = subprocess.check_output(cmd)
+    subprocess.check_output(['git', '-C', repo_root, 'update-ref', '--stdin'], input=refs)
 
 # Import to a new repository.
-def importtorepo(repo_root, commands, branch, use_git_filter_repo):
-    # Generate a string from the export description.
-    import_str = makeimport(commands)
-
+def importtorepo(repo_root, commands, branch, use_git_filter_repo, marks_path = None):
     # Initialize the repository.
     cmd = ['git', 'init', repo_root]
     subprocess.check_call(cmd)
 
     if(use_git_filter_repo):
-        # Import the fast-import string into the repo using git-filter-repo
+        # Import the fast-import stream into the repo using git-filter-repo
         # This will update hash references in commit logs.
-        p = subprocess.Popen(['git-filter-repo', '--target', repo_root, '--stdin'], stdin=subprocess.PIPE)
-        p.communicate(input=import_str)
+        cmd = ['git-filter-repo', '--target', repo_root, '--stdin']
     else:
-        # Import the fast-import string into the repo.
-        p = subprocess.Popen(['git', '-C', repo_root, 'fast-import'], stdin=subprocess.PIPE)
-        p.communicate(input=import_str)
+        # Import the fast-import stream into the repo.
+        cmd = ['git', '-C', repo_root, 'fast-import']
+        if marks_path:
+            cmd.append('--export-marks=' + os.path.abspath(marks_path))
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, bufsize=-1)
+    writeimport(p.stdin, commands)
+    p.stdin.close()
+    p.wait()
 
     # Checkout the tip of the main branch.
     cmd = ['git', '-C', repo_root, 'reset', '--hard', branch]
@@ -126,114 +433,19 @@ def importtorepo(repo_root, commands, branch, use_git_filter_repo):
 
 # Prefix a path with a sub directory, taking ":s into account.
 def prefixpath(prefix, path):
-    if path[0] == b'"':
-        assert(path[len(path) - 1] == b'"')
+    if path[:1] == b'"':
+        assert(path[-1:] == b'"')
         return b'"' + prefix + path[1:]
     else:
         return prefix + path
 
 # Rewrite a .gitsubmodes file for putting modules in a new subdir.
 def prefixgitsubmodules(prefix, data):
-    nl_pos = data.find('\n')
+    nl_pos = data.find(b'\n')
     assert(nl_pos >= 0)
     blob = data[(nl_pos + 1):].replace(b'path = ', b'path = ' + prefix)
     return b'data ' + str(len(blob)).encode('utf-8') + b'\n' + blob
 
-# Move all files to a subdirectory.
-def movetosubdir(commands, subdir):
-    if subdir[-1:] != b'/':
-        subdir += b'/'
-
-    found_gitmodules = False
-    mark_to_data_idx_map = {}
-    for k in range(0, len(commands)):
-        cmd = commands[k]
-
-        # Pick up data blobs for .gitmodules.
-        if cmd == b'blob':
-            assert((k + 2) < len(commands))
-            mark = commands[k + 1]
-            assert(mark[:4] == b'mark')
-            mark = mark[5:]
-            mark_to_data_idx_map[mark] = k + 2
-
-        # Commands that reference paths: 'M', 'D', 'C' and 'R'.
-        cmd_type = cmd[:2]
-        if cmd_type == b'M ':
-            parts = cmd.split(b' ')
-            path = b' '.join(parts[3:])
-            if path == b'.gitmodules':
-                mark = parts[2]
-                data_idx = mark_to_data_idx_map[mark]
-                commands[data_idx] = prefixgitsubmodules(subdir, commands[data_idx])
-                found_gitmodules = True
-            else:
-                path = prefixpath(subdir, path)
-            cmd = b' '.join(parts[:3]) + b' ' + path
-            commands[k] = cmd
-        elif cmd_type == b'D ':
-            path = cmd[2:]
-            if path == b'.gitmodules':
-                found_gitmodules = True
-            else:
-                path = prefixpath(subdir, path)
-            commands[k] = cmd[:2] + path
-        elif (cmd_type == b'C ') or (cmd_type == b'R '):
-            if cmd[2] == b'"':
-                src_end = cmd.find(b'"', 3)
-                # TODO(m): Support escaped quotes.
-                assert(src_end >= 0 and cmd[src_end - 1] != b'\\')
-            else:
-                src_end = cmd.find(b' ', 3) - 1
-                assert(src_end >= 0)
-            src_path = prefixpath(subdir, cmd[2:(src_end + 1)])
-            dst_path = prefixpath(subdir, cmd[(src_end + 2):])
-            commands[k] = cmd_type + src_path + b' ' + dst_path
-
-    return found_gitmodules
-
-# Get the maximum mark number.
-def getmaxmark(commands):
-    max_mark = 0
-    for cmd in commands:
-        if cmd[:5] == b'mark ':
-            mark = int(cmd[6:].decode('utf-8'))
-            if mark > max_mark:
-                max_mark = mark
-    return max_mark
-
-# Renumber all marks (add an offset).
-def renumbermarks(commands, mark_offset):
-    for k in range(0, len(commands)):
-        cmd = commands[k]
-
-        colon_pos = cmd.find(b':')
-        if (colon_pos > 0):
-            # Handle 'mark', 'from' and 'merge'.
-            if cmd[:colon_pos] in [b'mark ', b'from ', b'merge ']:
-                mark_pos = colon_pos + 1
-                mark = int(cmd[mark_pos:].decode('utf-8')) + mark_offset
-                commands[k] = cmd[:mark_pos] + str(mark).encode('utf-8')
-
-            # Handle 'M'.
-            elif cmd[:2] == b'M ':
-                parts = cmd.split(b' ')
-                if parts[2][0] == ord(b':'):
-                    mark = int(parts[2][1:]) + mark_offset
-                    parts[2] = b':' + str(mark).encode('utf-8')
-                    commands[k] = b' '.join(parts)
-
-            # Handle 'N'.
-            elif cmd[:2] == b'N ':
-                parts = cmd.split(b' ')
-                if parts[1][0] == ord(b':'):
-                    mark = int(parts[1][1:]) + mark_offset
-                    parts[1] = b':' + str(mark).encode('utf-8')
-                if parts[2][0] == ord(b':'):
-                    mark = int(parts[2][1:]) + mark_offset
-                    parts[2] = b':' + str(mark).encode('utf-8')
-                commands[k] = b' '.join(parts)
-
 # Parse the time stamp from an 'author'/'committer' command.
 def extracttimestamp(cmd):
     # The time stamp comes directly after the e-mail address (enclosed in <>).
@@ -244,69 +456,6 @@ def extracttimestamp(cmd):
     t = float(parts[0].decode('utf-8'))
     return t
 
-# Get the log for a specific branch (first-child traversal).
-def getlog(commands, branch, repo_id):
-    log = []
-
-    ref_names = [b'refs/heads/' + branch, b'refs/heads/origin/' + branch]
-
-    # Walk backwards.
-    parent_mark = b''
-    for k in reversed(range(len(commands))):
-        cmd = commands[k]
-
-        if parent_mark == b'':
-            # Find the tip of the branch. (Is introduced by a reset command)
-            if (cmd[:6] == b'reset ') and (cmd[6:] in ref_names):
-                # Found it! Look if we have a 'from' command.
-                cmd2 = commands[k + 1]
-                if cmd2[:6] == b'from :':
-                    parent_mark = b'mark :' + cmd2[6:]
-
-            # Find the tip of the branch. (Is directly intruduced by a commit command)
-            elif (cmd[:7] == b'commit ') and (cmd[7:] in ref_names):
-                cmd2_idx = k + 2
-                # 'original-oid' (optional) comes after 'mark'.
-                if commands[cmd2_idx][:13] == b'original-oid ':
-                    cmd2_idx = cmd2_idx + 1
-                # 'author' (optional) comes after 'mark'.
-                if commands[cmd2_idx][:7] == b'author ':
-                    cmd2_idx = cmd2_idx + 1
-                # 'committer' (required) comes after 'author'.
-                time_stamp = extracttimestamp(commands[cmd2_idx])
-                cmd2_idx = cmd2_idx + 2
-
-                log.append({'mark': commands[k + 1], 'time': time_stamp, 'id': repo_id})
-
-                # 'from' (optional) comes after 'committer' and 'data'.
-                if commands[cmd2_idx][:5] == b'from ':
-                    parent_mark = b'mark ' + commands[cmd2_idx][5:]
-
-        # Find the next parent commit.
-        elif (cmd[:7] == b'commit ') and (commands[k + 1] == parent_mark):
-            cmd2_idx = k + 2
-            # 'original-oid' (optional) comes after 'mark'.
-            if commands[cmd2_idx][:13] == b'original-oid ':
-                cmd2_idx = cmd2_idx + 1
-            # 'author' (optional) comes after 'mark'.
-            if commands[cmd2_idx][:7] == b'author ':
-                cmd2_idx = cmd2_idx + 1
-            # 'committer' (required) comes after 'author'.
-            time_stamp = extracttimestamp(commands[cmd2_idx])
-            cmd2_idx = cmd2_idx + 2
-
-            log.append({ 'mark': commands[k + 1], 'time': time_stamp, 'id': repo_id })
-
-            # 'from' (optional) comes after 'committer' and 'data'.
-            if commands[cmd2_idx][:5] == b'from ':
-                parent_mark = b'mark ' + commands[cmd2_idx][5:]
-            else:
-                # End of log (no more parents)
-                break
-
-    # Return the reversed log (oldest commit first).
-    return log[::-1]
-
 # Combine logs in a commit-date order.
 def combinelogs(log1, log2):
     log = []
@@ -334,20 +483,6 @@ def combinelogs(log1, log2):
 
     return log
 
-# Rename all refs.
-def renamerefs(commands, suffix = b''):
-    for k in range(0, len(commands)):
-        cmd = commands[k]
-
-        space_pos = cmd.find(b' ')
-        if (space_pos > 0):
-            # Handle 'commit', 'reset' and 'tag'.
-            if cmd[:space_pos] in [b'commit', b'reset', b'tag']:
-                cmd = cmd.replace(b'refs/remotes/origin/', b'refs/heads/', 1)
-                if suffix:
-                    cmd = cmd + suffix
-                commands[k] = cmd
-
 # Remap parent commit marks.
 def remapmark(cmd, mark_map):
     # Remap any 'from' commands according to the mark_map.
@@ -360,25 +495,17 @@ def remapmark(cmd, mark_map):
     return cmd
 
 # Merge two repositories.
-def mergerpos(main_commands, secondary_commands, main_spec, secondary_spec):
-    # Renumber the marks in the secondary command set.
-    renumbermarks(secondary_commands, getmaxmark(main_commands))
+# NOTE: The marks of the secondary repository must already be renumbered so that
+# they do not collide with the marks of the main repository.
+def mergerpos(main_repo, secondary_repo, max_memory):
+    main_commands = main_repo['commands']
+    secondary_commands = secondary_repo['commands']
 
-    # Get a log of the main branch in the main command set.
-    main_log = getlog(main_commands, main_spec['branch'].encode('utf-8'), 0)
-
-    # Get a log of the main branch in the secondary command set.
-    # NOTE: This has to be done before all the refs are renamed.
-    secondary_log = getlog(secondary_commands, secondary_spec['branch'].encode('utf-8'), 1)
-
-    # Sort the logs into a unified log.
-    combined_log = combinelogs(main_log, secondary_log)
-
-    # Rename all refs in the secondary command set.
-    renamerefs(secondary_commands, b'-' + secondary_spec['name'].encode('utf-8'))
+    # Sort the logs of the main branches into a unified log.
+    combined_log = combinelogs(main_repo['log'], secondary_repo['log'])
 
     # Combine both repos into a single command sequence.
-    commands = []
+    commands = newcommandlist(max_memory)
     sources = [{ 'idx': 0, 'commands': main_commands },
                { 'idx': 0, 'commands': secondary_commands }]
     log_idx = 0
@@ -424,6 +551,7 @@ def mergerpos(main_commands, secondary_commands, main_spec, secondary_spec):
                 first_commit_of_branch = False
 
                 # Finish this commit.
+                got_message = False
                 for i in range(k, len(src_commands)):
                     cmd = src_commands[i]
                     space_pos = cmd.find(b' ')
@@ -435,11 +563,15 @@ def mergerpos(main_commands, secondary_commands, main_spec, secondary_spec):
                     else:
                         commands.append(remapmark(cmd, mark_map))
                         if new_parent_cmd:
-                            if cmd_type == b'data':
+                            # The parent goes after the commit message (the
+                            # first 'data', any later ones are inline files).
+                            if cmd_type == b'data' and not got_message:
                                 commands.append(new_parent_cmd)
                             elif cmd_type == b'from':
                                 # Sanity check: There should be no 'from' here.
                                 raise ValueError('Unexpected from command.')
+                        if cmd_type == b'data':
+                            got_message = True
 
                 # Remember which mark caused us to break from the command stream.
                 mark_before_break = next_mark[5:]
@@ -470,65 +602,249 @@ def mergerpos(main_commands, secondary_commands, main_spec, secondary_spec):
 
         last_branch_id = current_branch_id
 
-    return commands
-
-# Handle the program arguments.
-parser = argparse.ArgumentParser(
-    formatter_class=argparse.RawTextHelpFormatter,
-    description='Generate a new repository with stitched histories from two or more repositories.',
-    epilog=('A repository specification is given on the following format:\n' +
-           '  path[,name][:mainbranch]\n' +
-           '    path       - Root of the Git repository.\n' +
-           '    name       - Name of the repository (used for the subdir).\n' +
-           '                 (default: last part of the path)\n' +
-           '    mainbranch - The main branch of the repository.\n' +
-           '                 (default: master)\n'))
-parser.add_argument('-n', '--no-subdirs', action='store_true', help='do not create subdirectories')
-parser.add_argument('-p', '--use-git-filter-repo', action='store_true', help='preserve hash references in commit messages by using git-filter-repo to import the stiched repo')
-parser.add_argument('-o', '--output', metavar='OUTPUT', required='True', help='output directory for the stitched Git repo')
-parser.add_argument('main', metavar='MAIN', help='main repository specification')
-parser.add_argument('secondary', metavar='SECONDARY', nargs='+', help='secondary repository specification')
-args = parser.parse_args()
-
-# Should we append subdirs?
-move_to_subdirs = not args.no_subdirs
-use_git_filter_repo = args.use_git_filter_repo
-
-# TODO(m): Support more than one repo with submodules (requires merging .gitmodules from several
-# repos, over time, ...).
-already_have_submodules = False
-
-# Export the main repository.
-main_spec = getrepospec(args.main)
-print('Exporting the main repository (' + main_spec['name'] + ')...')
-main_commands = exportrepo(main_spec['path'])
-if move_to_subdirs:
-    found_submodules = movetosubdir(main_commands, main_spec['name'].encode('utf-8'))
-    if found_submodules:
-        assert(not already_have_submodules)
-        already_have_submodules = True
-renamerefs(main_commands)
-
-# For each secondary repository...
-for secondary in args.secondary:
-    secondary_spec = getrepospec(secondary)
-    print('\nExporting ' + secondary_spec['name'] + '...')
-    secondary_commands = exportrepo(secondary_spec['path'])
-    if move_to_subdirs:
-        found_submodules = movetosubdir(secondary_commands, secondary_spec['name'].encode('utf-8'))
-        if found_submodules:
+    # The first-parent history of the main branch in the merged command
+    # sequence is the combined log, up to the tip of the main branch.
+    log_end = 0
+    for k in range(len(combined_log)):
+        if combined_log[k]['id'] == 0:
+            log_end = k + 1
+    log = [{ 'mark': x['mark'], 'time': x['time'], 'id': 0 } for x in combined_log[:log_end]]
+
+    return { 'commands': commands,
+             'log': log,
+             'max_mark': max(main_repo['max_mark'], secondary_repo['max_mark']),
+             'found_gitmodules': main_repo['found_gitmodules'] or secondary_repo['found_gitmodules'] }
+
+# Get all the refs of a repository (the ones that are exported with --all).
+def getrefs(repo_root):
+    cmd = ['git', '-C', repo_root, 'for-each-ref', '--format=%(refname)']
+    return subprocess.check_output(cmd).decode('utf-8').splitlines()
+
+# Get the log for the main branch of a repository (first-parent traversal) from
+# the commit metadata only. The log entries have the same form as the ones that
+# are collected by parseexport(), except that 'mark' holds the commit SHA.
+def getplanlog(repo_spec, refs, repo_id):
+    # Find the tip of the branch (same refs as in parseexport()).
+    branch = repo_spec['branch']
+    tip_ref = ''
+    for ref in ['refs/heads/' + branch, 'refs/remotes/origin/' + branch, 'refs/heads/origin/' + branch]:
+        if ref in refs:
+            tip_ref = ref
+            break
+    if not tip_ref:
+        return []
+
+    cmd = ['git', '-C', repo_spec['path'], 'log', '--first-parent', '--format=%H %ct', tip_ref]
+    log = []
+    for line in subprocess.check_output(cmd).decode('utf-8').splitlines():
+        (sha, time_stamp) = line.split(' ')
+        log.append({ 'mark': sha, 'time': float(time_stamp), 'id': repo_id })
+
+    # Return the reversed log (oldest commit first).
+    return log[::-1]
+
+# Get the number of commits in a repository.
+def getcommitcount(repo_root):
+    cmd = ['git', '-C', repo_root, 'rev-list', '--all', '--count']
+    return int(subprocess.check_output(cmd).decode('utf-8'))
+
+# Estimate the size of the export of a repository (the total size of all
+# objects, uncompressed).
+def getexportsize(repo_root):
+    cmd = ['git', '-C', repo_root, 'cat-file', '--batch-all-objects', '--batch-check=%(objectsize)']
+    return sum([int(x) for x in subprocess.check_output(cmd).split()])
+
+# Format a time stamp as a date.
+def formatdate(time_stamp):
+    return time.strftime('%Y-%m-%d', time.gmtime(time_stamp))
+
+# Plan the join of the repositories, using the commit metadata only (no blobs are
+# exported), and print the plan.
+def planjoin(main_spec, secondary_specs):
+    specs = [main_spec] + secondary_specs
+    total_commits = 0
+    total_size = 0
+    for repo_id in range(len(specs)):
+        spec = specs[repo_id]
+        refs = getrefs(spec['path'])
+        commit_count = getcommitcount(spec['path'])
+        export_size = getexportsize(spec['path'])
+        total_commits += commit_count
+        total_size += export_size
+        print(spec['name'] + ' (' + spec['path'] + '):')
+        print('  Commits:             %d' % (commit_count))
+        print('  Estimated size:      %.1f MiB' % (export_size / 1048576.0))
+
+        # Rename all refs (same as in parseexport()).
+        ref_suffix = ('-' + spec['name']) if repo_id > 0 else ''
+        renamed_refs = 0
+        for ref in refs:
+            new_ref = ref.replace('refs/remotes/origin/', 'refs/heads/', 1) + ref_suffix
+            if new_ref != ref:
+                print('  Rename ref:          ' + ref + ' -> ' + new_ref)
+                renamed_refs += 1
+        print('  Renamed refs:        %d of %d' % (renamed_refs, len(refs)))
+
+        # Stitch the logs (same as in mergerpos()).
+        log = getplanlog(spec, refs, repo_id)
+        print('  Main branch commits: %d' % (len(log)))
+        if repo_id == 0:
+            main_log = log
+        else:
+            combined_log = combinelogs(main_log, log)
+            log_end = 0
+            for k in range(len(combined_log)):
+                if combined_log[k]['id'] != repo_id:
+                    log_end = k + 1
+            main_log = combined_log[:log_end]
+            tail_count = len(combined_log) - log_end
+            if tail_count > 0:
+                print('  Commits after the tip of the main branch: %d' % (tail_count))
+
+    # Print the stitched first-parent history, as runs of commits from the same
+    # repository.
+    print('\nStitched main branch (' + main_spec['branch'] + '):')
+    branch_switches = 0
+    run_start = 0
+    for k in range(1, len(main_log) + 1):
+        if k == len(main_log) or main_log[k]['id'] != main_log[run_start]['id']:
+            first = main_log[run_start]
+            last = main_log[k - 1]
+            print('  %-20s %6d commits  %s .. %s' % (specs[first['id']]['name'], k - run_start,
+                                                    formatdate(first['time']), formatdate(last['time'])))
+            if k < len(main_log):
+                branch_switches += 1
+            run_start = k
+
+    print('\nMain branch commits:  %d' % (len(main_log)))
+    print('Branch switches:      %d' % (branch_switches))
+    print('Total commits:        %d' % (total_commits))
+    print('Estimated size:       %.1f MiB' % (total_size / 1048576.0))
+
+def main():
+    # Handle the program arguments.
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description='Generate a new repository with stitched histories from two or more repositories.',
+        epilog=('A repository specification is given on the following format:\n' +
+               '  path[,name][:mainbranch]\n' +
+               '    path       - Root of the Git repository.\n' +
+               '    name       - Name of the repository (used for the subdir).\n' +
+               '                 (default: last part of the path)\n' +
+               '    mainbranch - The main branch of the repository.\n' +
+               '                 (default: master)\n'))
+    parser.add_argument('-n', '--no-subdirs', action='store_true', help='do not create subdirectories')
+    parser.add_argument('-p', '--use-git-filter-repo', action='store_true', help='preserve hash references in commit messages by using git-filter-repo to import the stiched repo')
+    parser.add_argument('-O', '--optimize', action='store_true', help='optimize the stitched repo (repack, and write bitmaps and a commit-graph)')
+    parser.add_argument('-m', '--max-memory', metavar='SIZE', type=parsesize, help='memory budget for the command streams, e.g. 4G (spill to\ntemporary files when exceeded, see TMPDIR)')
+    parser.add_argument('-v', '--verify', action='store_true', help='verify that every rewritten commit matches its source commit')
+    parser.add_argument('-d', '--dry-run', action='store_true', help='only print the plan for the join (uses commit metadata only)')
+    parser.add_argument('-e', '--engine', choices=['stream', 'objects'], default='stream', help='join engine: "stream" rewrites all the files in the export\nstreams, "objects" copies the source objects as is and\nwraps the root trees in the subdirectories (less I/O)\nDefault: stream')
+    parser.add_argument('-c', '--cache', metavar='DIR', help='cache directory for the rewritten exports of the repositories\n(only repositories with changed refs are exported again)')
+    parser.add_argument('--profile', metavar='DIR', help='write profiles of the parent and the worker processes, and a\nsummary of the hot functions per phase, to DIR')
+    parser.add_argument('-o', '--output', metavar='OUTPUT', help='output directory for the stitched Git repo')
+    parser.add_argument('main', metavar='MAIN', help='main repository specification')
+    parser.add_argument('secondary', metavar='SECONDARY', nargs='+', help='secondary repository specification')
+    args = parser.parse_args()
+    if not (args.output or args.dry_run):
+        parser.error('the following arguments are required: -o/--output')
+    if args.verify and (args.no_subdirs or args.use_git_filter_repo):
+        parser.error('argument -v/--verify: not allowed with -n/--no-subdirs or -p/--use-git-filter-repo')
+    if args.engine == 'objects' and (args.no_subdirs or args.use_git_filter_repo or args.cache):
+        parser.error('argument -e/--engine objects: not allowed with -n/--no-subdirs, -p/--use-git-filter-repo or -c/--cache')
+
+    # Should we append subdirs?
+    move_to_subdirs = not args.no_subdirs
+    use_git_filter_repo = args.use_git_filter_repo
+    max_memory = args.max_memory
+    cache_dir = args.cache
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    if args.profile:
+        initprofiling(args.profile)
+
+    # Just print the plan?
+    main_spec = getrepospec(args.main)
+    if args.dry_run:
+        setphase('plan')
+        planjoin(main_spec, [getrepospec(x) for x in args.secondary])
+        finishprofiling()
+        sys.exit(0)
+
+    # TODO(m): Support more than one repo with submodules (requires merging .gitmodules from several
+    # repos, over time, ...).
+
+    # Export the main repository.
+    print('Exporting the main repository (' + main_spec['name'] + ')...')
+    setphase('export')
+    if args.engine == 'objects':
+        main_repo = exportrepoobjects(main_spec, b'', 0, 0, max_memory)
+    else:
+        main_repo = exportrepo(main_spec, move_to_subdirs, b'', 0, 0, max_memory, cache_dir)
+    already_have_submodules = main_repo['found_gitmodules']
+
+    # Keep track of which marks belong to which repository (for verification).
+    mark_ranges = [(1, main_repo['max_mark'], main_spec)]
+
+    # For each secondary repository...
+    for secondary in args.secondary:
+        secondary_spec = getrepospec(secondary)
+        print('\nExporting ' + secondary_spec['name'] + '...')
+        ref_suffix = b'-' + secondary_spec['name'].encode('utf-8')
+        setphase('export')
+        if args.engine == 'objects':
+            secondary_repo = exportrepoobjects(secondary_spec, ref_suffix, main_repo['max_mark'], 1, max_memory)
+        else:
+            secondary_repo = exportrepo(secondary_spec, move_to_subdirs, ref_suffix, main_repo['max_mark'], 1, max_memory, cache_dir)
+        if secondary_repo['found_gitmodules']:
             assert(not already_have_submodules)
             already_have_submodules = True
+        mark_ranges.append((main_repo['max_mark'] + 1, secondary_repo['max_mark'], secondary_spec))
 
-    print('\nMerging repositories...')
-    main_commands = mergerpos(main_commands, secondary_commands, main_spec, secondary_spec)
-
-# Create the new repository and import the stitched histories.
-out_root = args.output
-if os.path.isdir(out_root):
-    cleandir(out_root)
-else:
-    os.makedirs(out_root)
-print('\nImporting result to ' + os.path.abspath(out_root) + '...')
-importtorepo(out_root, main_commands, main_spec['branch'], use_git_filter_repo)
+        print('\nMerging repositories...')
+        setphase('merge')
+        main_repo = mergerpos(main_repo, secondary_repo, max_memory)
 
+    # Create the new repository and import the stitched histories.
+    out_root = args.output
+    if os.path.isdir(out_root):
+        cleandir(out_root)
+    else:
+        os.makedirs(out_root)
+    if args.engine == 'objects':
+        print('\nCopying objects to ' + os.path.abspath(out_root) + '...')
+        setphase('copy')
+        copyobjects(out_root, [x[2] for x in mark_ranges])
+    print('\nImporting result to ' + os.path.abspath(out_root) + '...')
+    (fd, marks_path) = tempfile.mkstemp(prefix='git-tools-', suffix='.marks')
+    os.close(fd)
+    ok = True
+    try:
+        setphase('import')
+        importtorepo(out_root, main_repo['commands'], main_spec['branch'], use_git_filter_repo, marks_path if args.verify else None)
+        if args.engine == 'objects':
+            removecopiedrefs(out_root)
+        if args.optimize:
+            setphase('optimize')
+            optimizerepo(out_root)
+
+        # Verify the rewritten commits against the source commits.
+        if args.verify:
+            setphase('verify')
+            marks = readmarks(marks_path)
+            jobs = []
+            for (mark, original_oid) in getcommitoids(main_repo['commands']):
+                mark_num = int(mark[1:])
+                spec = [x[2] for x in mark_ranges if x[0] <= mark_num and mark_num <= x[1]][0]
+                jobs.append((spec['path'], original_oid, out_root, marks[mark], spec['name'].encode('utf-8')))
+            config = { 'oid_map': None, 'allowed_change_fun': None, 'ignore_root_names': [b'.gitmodules'] }
+            ok = verifyhistory(jobs, config)
+    finally:
+        os.unlink(marks_path)
+
+    finishprofiling()
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
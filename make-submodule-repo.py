@@ -20,7 +20,11 @@
   3. This notice may not be removed or altered from any source distribution.
 """
 
-import argparse, os, shutil, subprocess, tempfile
+import argparse, os, shutil, subprocess, sys, tempfile
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'helpers'))
+from optimizerepo import optimizerepo
+from profiling import finishprofiling, initprofiling, setphase
 
 _DEFAULT_BRANCH = 'master'
 
@@ -36,11 +40,15 @@ def cleandir(path):
         except Exception as e:
             print(e)
 
-# Get the Git log for a repository.
-def getlog(path, branch, name):
-    lines = subprocess.check_output(['git', '-C', path, 'log', '--first-parent', '--pretty=format:%H %ct %s', branch]).split('\n')
+# Get the Git log for a repository. If since_sha is given, only the commits after
+# that commit are included.
+def getlog(path, branch, name, since_sha = None):
+    rev = (since_sha + '..' + branch) if since_sha else branch
+    lines = subprocess.check_output(['git', '-C', path, 'log', '--first-parent', '--pretty=format:%H %ct %s', rev]).split('\n')
     log = []
     for line in lines:
+        if not line:
+            continue
         sep1_pos = line.find(' ')
         sep2_pos = line.find(' ', sep1_pos + 1)
         sha = line[:sep1_pos]
@@ -76,6 +84,26 @@ def combinelogs(log1, log2):
 
     return log
 
+# Get the submodule SHA that is recorded in the last commit of a repository (None
+# if there is no such submodule).
+def getrecordedsha(path, name):
+    out = subprocess.check_output(['git', '-C', path, 'ls-tree', 'HEAD', '--', name]).strip()
+    if not out:
+        return None
+    return out.split()[2]
+
+# Get the commit time of the last commit of a repository.
+def getlasttime(path):
+    return int(subprocess.check_output(['git', '-C', path, 'log', '-1', '--pretty=format:%ct']).strip())
+
+# Drop all the commits that are older than a given time, except for the newest
+# of them (i.e. the commit that was current at that time).
+def dropoldcommits(log, time):
+    first_idx = 0
+    while first_idx + 1 < len(log) and log[first_idx + 1]['time'] <= time:
+        first_idx = first_idx + 1
+    return log[first_idx:]
+
 def extractreponame(url):
     colon_pos = url.rfind(':')
     slash_pos = url.rfind('/')
@@ -90,12 +118,27 @@ parser = argparse.ArgumentParser(
     description='Create a repo with one or more submodules.')
 parser.add_argument('-o', '--output', metavar='OUTPUT', required='True', help='output directory for the Git repo')
 parser.add_argument('-b', '--branch', metavar='BRANCH', help='main branch name\nDefault: ' + _DEFAULT_BRANCH)
+parser.add_argument('-u', '--update', action='store_true', help='update an existing repo (only add the commits that are newer than the\nrecorded submodule SHAs)')
+parser.add_argument('-O', '--optimize', action='store_true', help='optimize the new repo (repack, and write bitmaps and a commit-graph)')
+parser.add_argument('--profile', metavar='DIR', help='write a profile, and a summary of the hot functions per phase,\nto DIR')
 parser.add_argument('sourcerepo', metavar='SOURCEREPO', nargs='+', help='URL for a source reppository')
 args = parser.parse_args()
 
 branch = args.branch if args.branch else _DEFAULT_BRANCH
+out_root = args.output
+if args.profile:
+    initprofiling(args.profile)
+
+# In update mode, get the state of the existing repository.
+if args.update:
+    if not os.path.isdir(os.path.join(out_root, '.git')):
+        print 'Not a Git repository: ' + out_root
+        sys.exit(1)
+    subprocess.check_call(['git', '-C', out_root, 'checkout', branch])
+    last_time = getlasttime(out_root)
 
 # Clone all repos to a temporary working directory (to get the logs).
+setphase('clone')
 work_root = tempfile.mkdtemp()
 log = []
 repos = {}
@@ -108,8 +151,15 @@ try:
         subprocess.check_call(['git', 'clone', url, repo_path])
         repos[repo_name] = { 'url': url, 'added': False }
 
-        # Get the log for this repo.
-        src_log = getlog(repo_path, branch, repo_name)
+        # Get the log for this repo. In update mode, only the commits after the
+        # recorded submodule SHA are needed. A submodule that is new to the repo
+        # starts at the commit that was current at the time of the last update.
+        recorded_sha = getrecordedsha(out_root, repo_name) if args.update else None
+        src_log = getlog(repo_path, branch, repo_name, recorded_sha)
+        if recorded_sha:
+            repos[repo_name]['added'] = True
+        elif args.update:
+            src_log = dropoldcommits(src_log, last_time)
         log = combinelogs(log, src_log)
 
 finally:
@@ -117,16 +167,24 @@ finally:
     cleandir(work_root)
     os.rmdir(work_root)
 
-# Create the new repository.
-out_root = args.output
-if os.path.isdir(out_root):
-    cleandir(out_root)
+if args.update:
+    # Fetch the new commits for the existing submodules.
+    for name in repos:
+        if repos[name]['added']:
+            subprocess.check_call(['git', '-C', out_root, 'submodule', 'update', '--init', name])
+            subprocess.check_call(['git', '-C', os.path.join(out_root, name), 'fetch', 'origin'])
+    print 'Adding %d new commits' % (len(log))
 else:
-    os.makedirs(out_root)
-subprocess.check_call(['git', '-C', out_root, 'init'])
-subprocess.check_call(['git', '-C', out_root, 'checkout', '-b', branch])
+    # Create the new repository.
+    if os.path.isdir(out_root):
+        cleandir(out_root)
+    else:
+        os.makedirs(out_root)
+    subprocess.check_call(['git', '-C', out_root, 'init'])
+    subprocess.check_call(['git', '-C', out_root, 'checkout', '-b', branch])
 
 # Add all the commits from the log.
+setphase('commit')
 git_env = os.environ.copy()
 for x in log:
     name = x['name']
@@ -146,3 +204,9 @@ for x in log:
     git_env['GIT_COMMITTER_DATE'] = str(x['time'])
     subprocess.check_call(['git', '-C', out_root, 'commit', '-m', name + ': ' + x['subject']], env=git_env)
 
+if args.optimize:
+    setphase('optimize')
+    optimizerepo(out_root)
+
+finishprofiling()
+